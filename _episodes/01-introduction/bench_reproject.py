@@ -0,0 +1,51 @@
+"""Compare pygeoprocessing.reproject_dataset_uri with reproject_tiled.
+
+Usage: python bench_reproject.py [raster] [n_workers ...]
+
+Reprojects the raster (default: the ASTER N37W120 DEM) to North Pole LAEA
+Alaska at 30 m with nearest-neighbor resampling, once with pygeoprocessing
+and once with reproject_tiled for each worker count, and prints wall times.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pygeoprocessing
+
+from projection_demos import ALASKA_SRS, DATA_DIR, reproject_tiled
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        src_path = sys.argv[1]
+    else:
+        src_path = os.path.join(DATA_DIR, 'ASTGTM2_N37W120_dem.tif')
+    worker_counts = [int(n) for n in sys.argv[2:]] or [1, 2, 4, 8]
+
+    workspace = tempfile.mkdtemp(prefix='bench_reproject_')
+    try:
+        elapsed = timed(pygeoprocessing.reproject_dataset_uri,
+                        original_dataset_uri=src_path,
+                        pixel_spacing=30,
+                        output_wkt=ALASKA_SRS,
+                        resampling_method='nearest',
+                        output_uri=os.path.join(workspace, 'pgp.tif'))
+        print('%-32s %8.2f s' % ('reproject_dataset_uri', elapsed))
+
+        for n_workers in worker_counts:
+            out_path = os.path.join(workspace, 'tiled_%d.tif' % n_workers)
+            elapsed = timed(reproject_tiled, src_path, out_path, ALASKA_SRS,
+                            pixel_spacing=30, resampling='nearest',
+                            n_workers=n_workers)
+            print('%-32s %8.2f s' % (
+                'reproject_tiled (%d workers)' % n_workers, elapsed))
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
@@ -1,24 +1,204 @@
+import math
+import multiprocessing
 import os
+import shutil
+import tempfile
 
 import matplotlib.pyplot as plt
 from osgeo import gdal
+from osgeo import gdal_array
 import numpy
-import pygeoprocessing
 
 CUR_DIR = os.path.dirname(__file__)
 DATA_DIR = os.path.join(CUR_DIR, '..', '..', 'docker', 'data')
 
+ALASKA_SRS = """PROJCS["WGS 84 / North Pole LAEA Alaska",
+    GEOGCS["WGS 84",
+        DATUM["WGS_1984",
+            SPHEROID["WGS 84",6378137,298.257223563,
+                AUTHORITY["EPSG","7030"]],
+            AUTHORITY["EPSG","6326"]],
+        PRIMEM["Greenwich",0,
+            AUTHORITY["EPSG","8901"]],
+        UNIT["degree",0.01745329251994328,
+            AUTHORITY["EPSG","9122"]],
+        AUTHORITY["EPSG","4326"]],
+    UNIT["metre",1,
+        AUTHORITY["EPSG","9001"]],
+    PROJECTION["Lambert_Azimuthal_Equal_Area"],
+    PARAMETER["latitude_of_center",90],
+    PARAMETER["longitude_of_center",-150],
+    PARAMETER["false_easting",0],
+    PARAMETER["false_northing",0],
+    AUTHORITY["EPSG","3572"],
+    AXIS["X",UNKNOWN],
+    AXIS["Y",UNKNOWN]]"""
 
-def render(filepath, title, out_filename):
-    ds = gdal.Open(filepath)
-    band = ds.GetRasterBand(1)
-    array = band.ReadAsArray()
-    array.astype(numpy.float32)
+# Per-process warped VRT for _warp_tile.  Each worker opens it once, so the
+# target CRS is parsed and the coordinate transformer set up once per
+# worker instead of once per tile.
+_WORKER = {}
+
+
+def read_blocks_decimated(band, factor):
+    """Read every ``factor``-th row and column of ``band``, block by block.
+
+    Blocks are read at the band's natural block size, and blocks that hold
+    none of the sampled rows (for example most scanlines of a strip-organized
+    file) are skipped.  The nodata mask is built per block, so memory stays
+    bounded by the output size plus one block.
+
+    Returns a numpy masked array.
+    """
+    out_xsize = int(math.ceil(band.XSize / float(factor)))
+    out_ysize = int(math.ceil(band.YSize / float(factor)))
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)
+    array = numpy.empty((out_ysize, out_xsize), dtype=dtype)
+    mask = numpy.zeros((out_ysize, out_xsize), dtype=bool)
     nodata = band.GetNoDataValue()
 
-    ma_array = numpy.ma.masked_array(array, mask=array==nodata)
+    block_xsize, block_ysize = band.GetBlockSize()
+    for yoff in range(0, band.YSize, block_ysize):
+        ysize = min(block_ysize, band.YSize - yoff)
+        # First sampled row in this block, relative to the block.
+        row0 = (-yoff) % factor
+        if row0 >= ysize:
+            continue
+        for xoff in range(0, band.XSize, block_xsize):
+            xsize = min(block_xsize, band.XSize - xoff)
+            col0 = (-xoff) % factor
+            if col0 >= xsize:
+                continue
+            block = band.ReadAsArray(xoff, yoff, xsize, ysize)
+            block = block[row0::factor, col0::factor]
+            out_row = (yoff + row0) // factor
+            out_col = (xoff + col0) // factor
+            out_slice = (slice(out_row, out_row + block.shape[0]),
+                         slice(out_col, out_col + block.shape[1]))
+            array[out_slice] = block
+            if nodata is not None:
+                mask[out_slice] = block == nodata
+    return numpy.ma.masked_array(array, mask=mask)
+
+
+def read_preview(band, max_size):
+    """Read ``band`` downsampled to at most ``max_size`` pixels on a side.
+
+    Reads from the coarsest overview that still has at least the target
+    resolution, so a quicklook of a large DEM touches only a few megabytes.
+    When the band has no suitable overview, falls back to
+    ``read_blocks_decimated``.
+
+    Returns a numpy masked array with nodata pixels masked.
+    """
+    factor = max(1, int(math.ceil(
+        max(band.XSize, band.YSize) / float(max_size))))
+    out_xsize = int(math.ceil(band.XSize / float(factor)))
+    out_ysize = int(math.ceil(band.YSize / float(factor)))
+
+    source = None
+    for ovr_index in range(band.GetOverviewCount()):
+        overview = band.GetOverview(ovr_index)
+        if (overview.XSize >= out_xsize and overview.YSize >= out_ysize and
+                (source is None or overview.XSize < source.XSize)):
+            source = overview
+    if source is None:
+        return read_blocks_decimated(band, factor)
+
+    array = source.ReadAsArray(buf_xsize=out_xsize, buf_ysize=out_ysize)
+    nodata = band.GetNoDataValue()
+    return numpy.ma.masked_array(array, mask=array==nodata)
+
+
+def _init_warp_worker(vrt_path):
+    _WORKER['vrt'] = gdal.Open(vrt_path)
+
+
+def _warp_tile(args):
+    """Warp one output tile.  Runs in a worker process."""
+    tile_path, xoff, yoff, xsize, ysize = args
+    # Reading a window of the warped VRT only warps that window, and the
+    # warper derives the source window, so only the part of the source
+    # that overlaps this tile is read.
+    gdal.Translate(tile_path, _WORKER['vrt'],
+                   srcWin=[xoff, yoff, xsize, ysize],
+                   creationOptions=['TILED=YES'])
+    return tile_path
+
+
+def reproject_tiled(src_path, out_path, target_wkt, pixel_spacing,
+                    resampling='nearest', tile_size=2048, n_workers=None,
+                    warp_memory_mb=256):
+    """Reproject a raster by warping output tiles in parallel.
+
+    A drop-in replacement for ``pygeoprocessing.reproject_dataset_uri``.
+    The output grid is split into ``tile_size`` square tiles, each tile is
+    warped in a pool of ``n_workers`` processes (default: all cores) with a
+    per-process warp memory limit of ``warp_memory_mb``, and the tiles are
+    assembled into a Cloud Optimized GeoTIFF at ``out_path``.
+    """
+    src = gdal.Open(src_path)
+    nodata = src.GetRasterBand(1).GetNoDataValue()
+
+    tile_dir = tempfile.mkdtemp(prefix='reproject_tiles_')
+    try:
+        # Let GDAL work out the output grid without warping any pixels.
+        # Workers warp their tiles out of this VRT.
+        vrt_path = os.path.join(tile_dir, 'warp.vrt')
+        grid = gdal.Warp(vrt_path, src, format='VRT', dstSRS=target_wkt,
+                         xRes=pixel_spacing, yRes=pixel_spacing,
+                         resampleAlg=resampling, srcNodata=nodata,
+                         dstNodata=nodata, warpMemoryLimit=warp_memory_mb)
+        grid_xsize, grid_ysize = grid.RasterXSize, grid.RasterYSize
+        grid = None
+        src = None
+
+        jobs = []
+        for yoff in range(0, grid_ysize, tile_size):
+            ysize = min(tile_size, grid_ysize - yoff)
+            for xoff in range(0, grid_xsize, tile_size):
+                xsize = min(tile_size, grid_xsize - xoff)
+                tile_path = os.path.join(
+                    tile_dir, 'tile_%d_%d.tif' % (yoff, xoff))
+                jobs.append((tile_path, xoff, yoff, xsize, ysize))
+
+        pool = multiprocessing.Pool(n_workers, initializer=_init_warp_worker,
+                                    initargs=(vrt_path,))
+        try:
+            tile_paths = pool.map(_warp_tile, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        mosaic = gdal.BuildVRT(os.path.join(tile_dir, 'mosaic.vrt'),
+                               tile_paths)
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        if gdal.GetDriverByName('COG') is not None:
+            gdal.Translate(out_path, mosaic, format='COG',
+                           creationOptions=['COMPRESS=DEFLATE',
+                                            'NUM_THREADS=ALL_CPUS'])
+        else:
+            # GDAL < 3.1: tiled GeoTIFF with internal overviews.
+            gdal.Translate(out_path, mosaic, format='GTiff',
+                           creationOptions=['TILED=YES', 'COMPRESS=DEFLATE'])
+            out = gdal.Open(out_path, gdal.GA_Update)
+            out.BuildOverviews('NEAREST', [2, 4, 8, 16, 32])
+            out = None
+        mosaic = None
+    finally:
+        shutil.rmtree(tile_dir, ignore_errors=True)
+
+
+def render(filepath, title, out_filename, dpi=75):
+    ds = gdal.Open(filepath)
+    band = ds.GetRasterBand(1)
     plt.clf()  # clear figure
 
+    # Only read as many pixels as the saved figure can show.
+    max_size = int(max(plt.gcf().get_size_inches()) * dpi)
+    ma_array = read_preview(band, max_size)
+
     plt.xticks(size='small')
     plt.yticks(size='small')
 
@@ -32,7 +212,7 @@ def render(filepath, title, out_filename):
     if os.path.exists(out_filename):
         os.remove(out_filename)
 
-    plt.savefig(out_filename, dpi=75, bbox_inches='tight')
+    plt.savefig(out_filename, dpi=dpi, bbox_inches='tight')
 
 if __name__ == '__main__':
     unproj_dem = os.path.join(DATA_DIR, 'ASTGTM2_N37W120_dem.tif')
@@ -44,35 +224,9 @@ if __name__ == '__main__':
            'ASTER N37W120 (UTM zone 11N)',
            'ASTER-N37W120-UTM11N.png')
 
-    alaska_srs = """PROJCS["WGS 84 / North Pole LAEA Alaska",
-    GEOGCS["WGS 84",
-        DATUM["WGS_1984",
-            SPHEROID["WGS 84",6378137,298.257223563,
-                AUTHORITY["EPSG","7030"]],
-            AUTHORITY["EPSG","6326"]],
-        PRIMEM["Greenwich",0,
-            AUTHORITY["EPSG","8901"]],
-        UNIT["degree",0.01745329251994328,
-            AUTHORITY["EPSG","9122"]],
-        AUTHORITY["EPSG","4326"]],
-    UNIT["metre",1,
-        AUTHORITY["EPSG","9001"]],
-    PROJECTION["Lambert_Azimuthal_Equal_Area"],
-    PARAMETER["latitude_of_center",90],
-    PARAMETER["longitude_of_center",-150],
-    PARAMETER["false_easting",0],
-    PARAMETER["false_northing",0],
-    AUTHORITY["EPSG","3572"],
-    AXIS["X",UNKNOWN],
-    AXIS["Y",UNKNOWN]]"""
-
     out_filename = 'ASTER_alaska.tif'
-    pygeoprocessing.reproject_dataset_uri(
-        original_dataset_uri=unproj_dem,
-        pixel_spacing=30,
-        output_wkt=alaska_srs,
-        resampling_method='nearest',
-        output_uri=out_filename)
+    reproject_tiled(unproj_dem, out_filename, ALASKA_SRS, pixel_spacing=30,
+                    resampling='nearest')
     render(out_filename,
            'ASTER N37W120 (North Pole LAEA Alaska)',
            'ASTER-N37W120-northpole.png')
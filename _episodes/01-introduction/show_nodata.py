@@ -1,4 +1,7 @@
+import math
 import os
+import threading
+from multiprocessing.pool import ThreadPool
 
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
@@ -7,6 +10,121 @@ import numpy
 
 cur_dir = os.path.dirname(__file__)
 
+def _scan_block(band, nodata, xoff, yoff, xsize, ysize, factor):
+    """Scan one block.
+
+    Returns (nodata pixel count, strided nodata sample, valid bbox or None).
+    """
+    row0 = (-yoff) % factor
+    col0 = (-xoff) % factor
+    sample_shape = (len(range(row0, ysize, factor)),
+                    len(range(col0, xsize, factor)))
+
+    # Sparse formats can tell us a block was never written without reading
+    # it (GDAL >= 2.2); such blocks read back as nodata, or as zeros (all
+    # valid, like the read path below) when the band has no nodata value.
+    if nodata is not None and hasattr(band, 'GetDataCoverageStatus'):
+        status = band.GetDataCoverageStatus(xoff, yoff, xsize, ysize)[0]
+        if status == gdal.GDAL_DATA_COVERAGE_STATUS_EMPTY:
+            return (xsize * ysize, numpy.ones(sample_shape, dtype=bool),
+                    None)
+
+    array = band.ReadAsArray(xoff, yoff, xsize, ysize)
+    if nodata is None:
+        is_nodata = numpy.zeros(array.shape, dtype=bool)
+    else:
+        is_nodata = array == nodata
+    valid_rows = numpy.flatnonzero(~is_nodata.all(axis=1))
+    valid_cols = numpy.flatnonzero(~is_nodata.all(axis=0))
+    bbox = None
+    if valid_rows.size:
+        bbox = (xoff + valid_cols[0], yoff + valid_rows[0],
+                xoff + valid_cols[-1] + 1, yoff + valid_rows[-1] + 1)
+    return (int(is_nodata.sum()), is_nodata[row0::factor, col0::factor],
+            bbox)
+
+
+def scan_nodata(filepath, factor=16, n_workers=None):
+    """Scan every block of a raster's first band for nodata.
+
+    Blocks are read at the band's natural block size in a pool of
+    ``n_workers`` threads, each with its own dataset handle.
+
+    Returns a dict with:
+        ``block_fraction``: nodata fraction of each block, shaped
+            (block rows, block columns).
+        ``bitmap``: boolean nodata map sampled every ``factor`` pixels.
+        ``valid_bbox``: (xmin, ymin, xmax, ymax) pixel bounds of valid data,
+            or None if the raster is entirely nodata.
+        ``nodata_fraction``: nodata fraction of the whole raster.
+    """
+    ds = gdal.Open(filepath)
+    band = ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    xsize, ysize = band.XSize, band.YSize
+    block_xsize, block_ysize = band.GetBlockSize()
+    n_block_cols = int(math.ceil(xsize / float(block_xsize)))
+    n_block_rows = int(math.ceil(ysize / float(block_ysize)))
+
+    block_fraction = numpy.zeros((n_block_rows, n_block_cols))
+    bitmap = numpy.zeros((int(math.ceil(ysize / float(factor))),
+                          int(math.ceil(xsize / float(factor)))), dtype=bool)
+    # GDAL dataset handles are not thread safe: one per thread.
+    local = threading.local()
+
+    def scan_block_row(block_row):
+        if not hasattr(local, 'band'):
+            local.ds = gdal.Open(filepath)
+            local.band = local.ds.GetRasterBand(1)
+        yoff = block_row * block_ysize
+        row_ysize = min(block_ysize, ysize - yoff)
+        bboxes = []
+        for block_col in range(n_block_cols):
+            xoff = block_col * block_xsize
+            col_xsize = min(block_xsize, xsize - xoff)
+            count, sample, bbox = _scan_block(
+                local.band, nodata, xoff, yoff, col_xsize, row_ysize, factor)
+            block_fraction[block_row, block_col] = (
+                count / float(col_xsize * row_ysize))
+            if sample.size:
+                out_row = (yoff + (-yoff) % factor) // factor
+                out_col = (xoff + (-xoff) % factor) // factor
+                bitmap[out_row:out_row + sample.shape[0],
+                       out_col:out_col + sample.shape[1]] = sample
+            if bbox is not None:
+                bboxes.append(bbox)
+        return bboxes
+
+    pool = ThreadPool(n_workers)
+    try:
+        bboxes = [bbox for row_bboxes in
+                  pool.map(scan_block_row, range(n_block_rows))
+                  for bbox in row_bboxes]
+    finally:
+        pool.close()
+        pool.join()
+
+    valid_bbox = None
+    if bboxes:
+        bboxes = numpy.array(bboxes)
+        valid_bbox = (int(bboxes[:, 0].min()), int(bboxes[:, 1].min()),
+                      int(bboxes[:, 2].max()), int(bboxes[:, 3].max()))
+
+    # Weight each block's fraction by its (possibly partial) pixel count.
+    block_widths = numpy.minimum(
+        block_xsize, xsize - numpy.arange(n_block_cols) * block_xsize)
+    block_heights = numpy.minimum(
+        block_ysize, ysize - numpy.arange(n_block_rows) * block_ysize)
+    block_pixels = numpy.outer(block_heights, block_widths)
+    nodata_fraction = ((block_fraction * block_pixels).sum() /
+                       float(xsize * ysize))
+
+    return {'block_fraction': block_fraction,
+            'bitmap': bitmap,
+            'valid_bbox': valid_bbox,
+            'nodata_fraction': nodata_fraction}
+
+
 def render(filepath):
     """Visualize different pixel values from landcover.tif."""
     ds = gdal.Open(filepath)
@@ -40,5 +158,14 @@ def render(filepath):
     plt.savefig(out_png_name, dpi=75, bbox_inches='tight')
 
 if __name__ == '__main__':
-    render(os.path.join(os.path.dirname(__file__), '..', '..', 'docker',
-                        'data', 'landcover.tif'))
+    landcover = os.path.join(os.path.dirname(__file__), '..', '..', 'docker',
+                             'data', 'landcover.tif')
+    render(landcover)
+
+    report = scan_nodata(landcover)
+    print('nodata fraction: %.3f' % report['nodata_fraction'])
+    print('valid data bbox (xmin, ymin, xmax, ymax): %s' %
+          (report['valid_bbox'],))
+    print('blocks entirely nodata: %d of %d' % (
+        (report['block_fraction'] == 1).sum(),
+        report['block_fraction'].size))
@@ -0,0 +1,139 @@
+"""Check that a BlockCache stops band_math from refetching remote blocks.
+
+Usage: python check_block_cache.py [n_workers]
+
+Writes a pair of small tiled GeoTIFFs, serves them from a local HTTP
+server that supports range requests and counts them, then runs
+band_math('ndvi') over the URLs twice with the same BlockCache.  The
+first run should fetch every block; the second should make no requests
+(GDAL keeps the file headers from the first run in its in-process cache,
+so any request there would be a refetched block).
+The server runs in its own process, so GDAL's reads in this one can't
+starve it of the GIL.
+"""
+import functools
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy
+import rasterio
+from rasterio.transform import from_origin
+
+from landsat_ndvi import BlockCache, band_math
+
+
+class RangeHandler(SimpleHTTPRequestHandler):
+    """Serve files with single byte-range support, counting GETs."""
+
+    def __init__(self, *args, **kwargs):
+        self.counter = kwargs.pop('counter')
+        SimpleHTTPRequestHandler.__init__(self, *args, **kwargs)
+
+    def log_message(self, *args):
+        pass
+
+    def _send_head(self, length, status=200, content_range=None):
+        self.send_response(status)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(length))
+        if content_range:
+            self.send_header('Content-Range', content_range)
+        self.end_headers()
+
+    def do_HEAD(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        self._send_head(os.path.getsize(path))
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with self.counter.get_lock():
+            self.counter.value += 1
+        with open(path, 'rb') as f:
+            data = f.read()
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match is None:
+            self._send_head(len(data))
+            self.wfile.write(data)
+            return
+        start = int(match.group(1))
+        end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+        self._send_head(end - start + 1, 206, 'bytes {}-{}/{}'.format(
+            start, end, len(data)))
+        self.wfile.write(data[start:end + 1])
+
+
+def serve(directory, counter, port):
+    handler = functools.partial(RangeHandler, directory=directory,
+                                counter=counter)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    port.value = server.server_address[1]
+    server.serve_forever()
+
+
+def write_band(path, seed, shape=(1024, 1280)):
+    rng = numpy.random.default_rng(seed)
+    profile = {'driver': 'GTiff', 'dtype': 'uint16', 'count': 1,
+               'height': shape[0], 'width': shape[1], 'crs': 'EPSG:32611',
+               'transform': from_origin(204285.0, 4268115.0, 30, 30),
+               'tiled': True, 'blockxsize': 256, 'blockysize': 256,
+               'compress': 'lzw', 'nodata': 0}
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(rng.integers(5000, 30000, size=shape, dtype='uint16'), 1)
+
+
+if __name__ == '__main__':
+    n_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+
+    workspace = tempfile.mkdtemp(prefix='check_block_cache_')
+    server = None
+    try:
+        data_dir = os.path.join(workspace, 'data')
+        os.makedirs(data_dir)
+        write_band(os.path.join(data_dir, 'red.tif'), 0)
+        write_band(os.path.join(data_dir, 'nir.tif'), 1)
+
+        counter = multiprocessing.Value('i', 0)
+        port = multiprocessing.Value('i', 0)
+        server = multiprocessing.Process(target=serve,
+                                         args=(data_dir, counter, port))
+        server.daemon = True
+        server.start()
+        while not port.value:
+            server.join(0.05)
+        url = 'http://127.0.0.1:{}/'.format(port.value)
+        bands = {'red': url + 'red.tif', 'nir': url + 'nir.tif'}
+
+        cache = BlockCache(os.path.join(workspace, 'blocks'))
+        requests = []
+        for run in (1, 2):
+            counter.value = 0
+            out_path = os.path.join(workspace, 'ndvi_{}.tif'.format(run))
+            band_math('ndvi', bands, out_path, n_workers=n_workers,
+                      cache=cache)
+            requests.append(counter.value)
+            print('run {}: {:4d} requests  {}'.format(
+                run, counter.value, cache.stats))
+
+        with rasterio.open(os.path.join(workspace, 'ndvi_1.tif')) as first, \
+                rasterio.open(os.path.join(workspace, 'ndvi_2.tif')) as second:
+            same = numpy.array_equal(first.read(1), second.read(1),
+                                     equal_nan=True)
+        print('outputs match: {}'.format(same))
+        if requests[1] or not same:
+            sys.exit('FAIL: the cached run refetched blocks or differed')
+        print('OK')
+    finally:
+        if server is not None:
+            server.terminate()
+        shutil.rmtree(workspace, ignore_errors=True)
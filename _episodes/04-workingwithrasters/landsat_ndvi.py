@@ -0,0 +1,708 @@
+"""Helpers for the Landsat 8 NDVI examples in episode 04.
+
+The episode walks through each step inline on decimated overviews; the
+functions here do the same work at scale (many points, full-resolution
+scenes) and can be imported from a notebook or run as a script.
+"""
+import csv
+import hashlib
+import math
+import os
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import numpy
+import pyproj
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+URL = ('http://landsat-pds.s3.amazonaws.com/c1/L8/042/034/'
+       'LC08_L1TP_042034_20170616_20170629_01_T1/')
+BAND = 'LC08_L1TP_042034_20170616_20170629_01_T1_B{}.TIF'
+# The same path/row a year later, for change detection
+URL2 = ('http://landsat-pds.s3.amazonaws.com/c1/L8/042/034/'
+        'LC08_L1TP_042034_20180619_20180703_01_T1/')
+BAND2 = 'LC08_L1TP_042034_20180619_20180703_01_T1_B{}.TIF'
+
+# Landsat 8 OLI band numbers by name.
+BANDS = {'blue': 2, 'green': 3, 'red': 4, 'nir': 5, 'swir1': 6, 'swir2': 7}
+
+# Spectral indices over named bands.  EVI's coefficients assume surface
+# reflectance, so scale DNs first, e.g. 'nir * 2.75e-5 - 0.2'.
+INDICES = {
+    'ndvi': '(nir - red) / (nir + red)',
+    'ndwi': '(green - nir) / (green + nir)',
+    'evi': '2.5 * (nir - red) / (nir + 6.0 * red - 7.5 * blue + 1.0)',
+}
+
+# GDAL settings for reading cloud-optimized GeoTIFFs over HTTP.  Sidecar
+# files (e.g. AWS's external .ovr overviews) are probed directly instead of
+# listing the bucket, the first request fetches the header with its
+# overview directories, adjacent block requests are merged into single
+# ranged reads, and recently read byte ranges are kept in memory.
+REMOTE_OPTIONS = {
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'YES',
+    'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.TIF,.tif,.ovr',
+    'GDAL_INGESTED_BYTES_AT_OPEN': 65536,
+    'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
+    'GDAL_HTTP_MULTIRANGE': 'YES',
+    'VSI_CACHE': 'TRUE',
+    'VSI_CACHE_SIZE': 64 * 2**20,
+}
+
+# Functions allowed in expressions; numexpr provides the same names.
+_FUNCTIONS = {'where': numpy.where, 'sqrt': numpy.sqrt, 'log': numpy.log,
+              'exp': numpy.exp, 'abs': numpy.abs}
+
+# Process-wide caches of parsed CRSs and coordinate transformers.  CRSs are
+# keyed both by the caller's input and by normalized WKT, so different
+# spellings of one CRS (rasterio CRS, 'EPSG:32611', a PROJ string) share a
+# transformer and PROJ setup happens once per CRS pair.
+_CRS_BY_INPUT = {}
+_CRS_BY_WKT = {}
+_TRANSFORMERS = {}
+_CACHE_LOCK = threading.Lock()
+CACHE_STATS = {'crs_hits': 0, 'crs_misses': 0,
+               'transformer_hits': 0, 'transformer_misses': 0}
+
+
+def _crs_key(crs):
+    # rasterio.crs.CRS is not hashable across versions; use its WKT.
+    if hasattr(crs, 'to_wkt'):
+        return crs.to_wkt()
+    return crs
+
+
+def get_crs(crs):
+    """Return a cached ``pyproj.CRS`` for any CRS-like input."""
+    key = _crs_key(crs)
+    with _CACHE_LOCK:
+        if key in _CRS_BY_INPUT:
+            CACHE_STATS['crs_hits'] += 1
+            return _CRS_BY_INPUT[key]
+        CACHE_STATS['crs_misses'] += 1
+        parsed = pyproj.CRS.from_user_input(key)
+        parsed = _CRS_BY_WKT.setdefault(parsed.to_wkt(), parsed)
+        _CRS_BY_INPUT[key] = parsed
+        return parsed
+
+
+def get_transformer(src_crs, dst_crs):
+    """Return a cached ``pyproj.Transformer`` (x/y, i.e. lon/lat, order)."""
+    src = get_crs(src_crs)
+    dst = get_crs(dst_crs)
+    key = (src.to_wkt(), dst.to_wkt())
+    with _CACHE_LOCK:
+        if key in _TRANSFORMERS:
+            CACHE_STATS['transformer_hits'] += 1
+            return _TRANSFORMERS[key]
+        CACHE_STATS['transformer_misses'] += 1
+        transformer = pyproj.Transformer.from_crs(src, dst, always_xy=True)
+        _TRANSFORMERS[key] = transformer
+        return transformer
+
+
+def lonlat_to_rowcol(src, lon, lat, transform=None):
+    """Convert lon/lat arrays to image rows and columns of ``src``.
+
+    ``transform`` defaults to ``src.transform``; pass the transform of a
+    decimated or windowed read to index into that array instead.
+    """
+    transformer = get_transformer('EPSG:4326', src.crs)
+    east, north = transformer.transform(numpy.asarray(lon, dtype=float),
+                                        numpy.asarray(lat, dtype=float))
+    if transform is None:
+        transform = src.transform
+    cols, rows = ~transform * (east, north)
+    return (numpy.floor(rows).astype(int), numpy.floor(cols).astype(int))
+
+
+class BlockCache(object):
+    """On-disk LRU cache of raster blocks, one .npy file per block.
+
+    Blocks are keyed by (path, overview level, band, block row, block
+    column).  Reads refresh a block's mtime, and once the cache grows past
+    ``max_bytes`` the least recently used blocks are deleted until it is
+    back under ``low_water`` times ``max_bytes``.  Writes go through a
+    temporary file and a rename, so several processes can share a cache
+    directory.
+
+    The LRU order and total size are kept in memory, seeded from the
+    files' mtimes when the cache is opened, so a put doesn't rescan the
+    directory.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 * 2**30, low_water=0.9):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._lock = threading.Lock()
+        entries = []
+        for name in os.listdir(cache_dir):
+            if name.endswith('.npy'):
+                st = os.stat(os.path.join(cache_dir, name))
+                entries.append((st.st_mtime, name, st.st_size))
+        # Block name -> size in bytes, least recently used first
+        self._lru = OrderedDict(
+            (name, size) for _, name, size in sorted(entries))
+        self._total = sum(self._lru.values())
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _name(self, key):
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.npy'
+
+    def get(self, key):
+        """Return the cached block for ``key``, or None."""
+        name = self._name(key)
+        path = os.path.join(self.cache_dir, name)
+        try:
+            block = numpy.load(path)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            # Missing, or evicted by another process mid-read
+            block = None
+        with self._lock:
+            self.stats['hits' if block is not None else 'misses'] += 1
+            if block is not None and name in self._lru:
+                self._lru.move_to_end(name)
+        return block
+
+    def put(self, key, block):
+        name = self._name(key)
+        path = os.path.join(self.cache_dir, name)
+        # Unique per process and thread, as processes may share cache_dir
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(),
+                                         threading.current_thread().ident)
+        with open(tmp_path, 'wb') as f:
+            numpy.save(f, block)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        evicted = []
+        with self._lock:
+            self._total += size - self._lru.pop(name, 0)
+            self._lru[name] = size
+            if self._total > self.max_bytes:
+                target = self.low_water * self.max_bytes
+                while self._total > target and len(self._lru) > 1:
+                    old, old_size = self._lru.popitem(last=False)
+                    self._total -= old_size
+                    evicted.append(old)
+                self.stats['evictions'] += len(evicted)
+        # Delete outside the lock, so other threads aren't held up
+        for old in evicted:
+            try:
+                os.remove(os.path.join(self.cache_dir, old))
+            except OSError:
+                pass
+
+
+def _runs(cols):
+    """Split sorted integers into runs of consecutive values."""
+    runs = []
+    for col in cols:
+        if runs and col == runs[-1][-1] + 1:
+            runs[-1].append(col)
+        else:
+            runs.append([col])
+    return runs
+
+
+class CachedReader(object):
+    """Read windows of a (remote) raster through a ``BlockCache``.
+
+    ``read(1, window=...)`` works like rasterio's for one band.  Blocks
+    already in the cache are not read again; missing blocks in each block
+    row are grouped into runs of neighbours, and each run is fetched with
+    one windowed read, which GDAL turns into merged range requests.  Pass
+    ``overview_level`` to read from an overview (0 is the first).
+    ``reads`` counts the reads that went to the raster itself.
+    """
+
+    def __init__(self, path, cache, overview_level=None):
+        self.path = path
+        self.cache = cache
+        self.overview_level = overview_level
+        kwargs = {}
+        if overview_level is not None:
+            kwargs['overview_level'] = overview_level
+        with rasterio.Env(**REMOTE_OPTIONS):
+            self.src = rasterio.open(path, **kwargs)
+        self.nodata = self.src.nodata
+        self.reads = 0
+        # rasterio dataset handles are not thread safe.
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.src.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _fetch(self, band, block_row, cols):
+        """Read a run of neighbouring blocks and cache each of them."""
+        block_y, block_x = self.src.block_shapes[band - 1]
+        col_off = cols[0] * block_x
+        row_off = block_row * block_y
+        window = Window(col_off, row_off,
+                        min(len(cols) * block_x, self.src.width - col_off),
+                        min(block_y, self.src.height - row_off))
+        with self._lock, rasterio.Env(**REMOTE_OPTIONS):
+            array = self.src.read(band, window=window)
+            self.reads += 1
+        blocks = {}
+        for n, col in enumerate(cols):
+            blocks[col] = array[:, n * block_x:(n + 1) * block_x]
+            self.cache.put((self.path, self.overview_level, band,
+                            block_row, col), blocks[col])
+        return blocks
+
+    def read(self, indexes=1, window=None):
+        band = indexes
+        if window is None:
+            window = Window(0, 0, self.src.width, self.src.height)
+        window = window.round_offsets().round_lengths()
+        row0, col0 = int(window.row_off), int(window.col_off)
+        row1, col1 = row0 + int(window.height), col0 + int(window.width)
+        block_y, block_x = self.src.block_shapes[band - 1]
+        out = numpy.empty((row1 - row0, col1 - col0),
+                          dtype=self.src.dtypes[band - 1])
+        cols = range(col0 // block_x, (col1 - 1) // block_x + 1)
+        for block_row in range(row0 // block_y, (row1 - 1) // block_y + 1):
+            blocks = {}
+            missing = []
+            for col in cols:
+                block = self.cache.get((self.path, self.overview_level, band,
+                                        block_row, col))
+                if block is None:
+                    missing.append(col)
+                else:
+                    blocks[col] = block
+            for run in _runs(missing):
+                blocks.update(self._fetch(band, block_row, run))
+            # Copy the part of each block that falls in the window
+            y0 = block_row * block_y
+            for col in cols:
+                x0 = col * block_x
+                r0, r1 = max(row0, y0), min(row1, y0 + block_y)
+                c0, c1 = max(col0, x0), min(col1, x0 + block_x)
+                out[r0 - row0:r1 - row0, c0 - col0:c1 - col0] = (
+                    blocks[col][r0 - y0:r1 - y0, c0 - x0:c1 - x0])
+        return out
+
+
+def plan_read(src, resolution=None, out_shape=None, window=None):
+    """Plan the cheapest read of ``src`` for a target resolution or shape.
+
+    ``resolution`` is the wanted pixel size in CRS units and ``out_shape``
+    the wanted (rows, cols); give one of them, or neither for a full
+    resolution read.  ``window`` is a full-resolution Window (default:
+    the whole raster), e.g. from ``rasterio.windows.from_bounds``.
+
+    The coarsest overview that is still at least as fine as the target
+    is used.  The window is snapped outward to whole pixels of that
+    overview, so its transform is exact.  GDAL only resamples further
+    (``decimated``) when no overview matches the target.  Returns a dict with:
+        ``overview_level``: index for ``rasterio.open(...,
+            overview_level=...)``, or None for full resolution.
+        ``window``: Window in the pixel grid of that level.
+        ``out_shape``: (rows, cols) of the array to read.
+        ``transform``: Affine transform of that array.
+        ``decimated``: whether out_shape is smaller than the window.
+    """
+    if window is None:
+        window = Window(0, 0, src.width, src.height)
+    if resolution is not None:
+        factor = float(resolution) / src.res[0]
+    elif out_shape is not None:
+        factor = max(window.height / float(out_shape[0]),
+                     window.width / float(out_shape[1]))
+    else:
+        factor = 1.0
+
+    # Overview factors from finest to coarsest, as in src.overviews(1)
+    level = None
+    for n, ov in enumerate(src.overviews(1)):
+        if ov <= factor * (1 + 1e-9):
+            level = n
+    width, height = src.width, src.height
+    if level is not None:
+        with rasterio.Env(**REMOTE_OPTIONS), rasterio.open(
+                src.name, overview_level=level) as ovr:
+            width, height = ovr.width, ovr.height
+    # Overview sizes are rounded, so use the actual scale per axis.
+    scale_x = src.width / float(width)
+    scale_y = src.height / float(height)
+    col0 = int(math.floor(window.col_off / scale_x + 1e-9))
+    row0 = int(math.floor(window.row_off / scale_y + 1e-9))
+    col1 = min(width, int(math.ceil(
+        (window.col_off + window.width) / scale_x - 1e-9)))
+    row1 = min(height, int(math.ceil(
+        (window.row_off + window.height) / scale_y - 1e-9)))
+    level_window = Window(col0, row0, col1 - col0, row1 - row0)
+    transform = (src.transform * rasterio.Affine.scale(scale_x, scale_y) *
+                 rasterio.Affine.translation(col0, row0))
+
+    shape = (row1 - row0, col1 - col0)
+    if resolution is not None:
+        shape = (max(1, int(round(shape[0] * scale_y * src.res[1] /
+                                  resolution))),
+                 max(1, int(round(shape[1] * scale_x * src.res[0] /
+                                  resolution))))
+    elif out_shape is not None:
+        shape = tuple(out_shape)
+    decimated = shape != (row1 - row0, col1 - col0)
+    if decimated:
+        transform = transform * rasterio.Affine.scale(
+            (col1 - col0) / float(shape[1]), (row1 - row0) / float(shape[0]))
+    return {'overview_level': level, 'window': level_window,
+            'out_shape': shape, 'transform': transform,
+            'decimated': decimated}
+
+
+def read_plan(path, plan, band=1, cache=None):
+    """Read one band as planned by ``plan_read``.
+
+    With a ``BlockCache``, reads that need no further decimation go
+    through ``CachedReader``.
+    """
+    if cache is not None and not plan['decimated']:
+        with CachedReader(path, cache, plan['overview_level']) as reader:
+            return reader.read(band, window=plan['window'])
+    kwargs = {}
+    if plan['overview_level'] is not None:
+        kwargs['overview_level'] = plan['overview_level']
+    with rasterio.Env(**REMOTE_OPTIONS), rasterio.open(path, **kwargs) as src:
+        return src.read(band, window=plan['window'],
+                        out_shape=plan['out_shape'])
+
+
+def sample_points(path, lon, lat, band=1, plan=None, cache=None,
+                  n_workers=None):
+    """Sample one band of a raster at many lon/lat points.
+
+    Coordinates are transformed in one vectorized call with a cached
+    transformer.  Points are then grouped by the block they fall in, and
+    each block that holds any points is read exactly once, in a pool of
+    ``n_workers`` threads (through ``CachedReader`` if a ``BlockCache``
+    is given).  With a ``plan_read`` plan, points are sampled from the
+    planned overview level and window, and georeferenced with the plan's
+    transform.  A decimated plan is read once as a whole array.
+
+    Returns (values, valid), where ``valid`` is False for points outside
+    the raster (or plan window) and for nodata pixels.
+    """
+    with rasterio.Env(**REMOTE_OPTIONS), rasterio.open(path) as src:
+        rows, cols = lonlat_to_rowcol(
+            src, lon, lat, plan['transform'] if plan is not None else None)
+        dtype = src.dtypes[band - 1]
+        nodata = src.nodata
+        shape = (src.height, src.width)
+    if plan is not None:
+        shape = plan['out_shape']
+    inside = ((rows >= 0) & (rows < shape[0]) &
+              (cols >= 0) & (cols < shape[1]))
+    values = numpy.zeros(rows.shape, dtype=dtype)
+
+    if plan is not None and plan['decimated']:
+        array = read_plan(path, plan, band, cache)
+        values[inside] = array[rows[inside], cols[inside]]
+    else:
+        level = None
+        if plan is not None:
+            level = plan['overview_level']
+            rows = rows + int(plan['window'].row_off)
+            cols = cols + int(plan['window'].col_off)
+        kwargs = {}
+        if level is not None:
+            kwargs['overview_level'] = level
+        with rasterio.Env(**REMOTE_OPTIONS), rasterio.open(
+                path, **kwargs) as src:
+            block_y, block_x = src.block_shapes[band - 1]
+            width, height = src.width, src.height
+
+        # Sort points by block, then split into one group per block
+        idx = numpy.flatnonzero(inside)
+        key = ((rows[idx] // block_y) * (width // block_x + 1) +
+               cols[idx] // block_x)
+        order = numpy.argsort(key, kind='mergesort')
+        idx, key = idx[order], key[order]
+        starts = numpy.flatnonzero(numpy.diff(key)) + 1
+        groups = numpy.split(idx, starts) if idx.size else []
+
+        # rasterio dataset handles are not thread safe: one per thread.
+        local = threading.local()
+
+        def sample_block(group):
+            row0 = rows[group[0]] // block_y * block_y
+            col0 = cols[group[0]] // block_x * block_x
+            window = Window(col0, row0, min(block_x, width - col0),
+                            min(block_y, height - row0))
+            with rasterio.Env(**REMOTE_OPTIONS):
+                if not hasattr(local, 'src'):
+                    if cache is None:
+                        local.src = rasterio.open(path, **kwargs)
+                    else:
+                        local.src = CachedReader(path, cache, level)
+                block = local.src.read(band, window=window)
+            return group, block[rows[group] - row0, cols[group] - col0]
+
+        pool = ThreadPool(n_workers)
+        try:
+            for group, block_values in pool.imap_unordered(sample_block,
+                                                           groups):
+                values[group] = block_values
+        finally:
+            pool.close()
+            pool.join()
+
+    valid = inside
+    if nodata is not None:
+        if numpy.isnan(nodata):
+            valid &= ~numpy.isnan(values)
+        else:
+            valid &= values != nodata
+    return values, valid
+
+
+def evaluate(expression, arrays):
+    """Evaluate a band-math expression over a dict of same-shape arrays.
+
+    ``expression`` is a key of ``INDICES`` or an arithmetic expression over
+    the names in ``arrays``.  Inputs are cast to float32 first (as in the
+    episode's ``calc_ndvi``), so unsigned DNs can't wrap around.  With
+    numexpr installed the whole expression runs in one multithreaded,
+    cache-sized pass with no full-size temporaries; otherwise numpy
+    evaluates it.  Division by zero gives inf/NaN without warnings.
+    """
+    expression = INDICES.get(expression, expression)
+    arrays = dict((name, numpy.asarray(array, dtype='f4'))
+                  for name, array in arrays.items())
+    if numexpr is not None:
+        result = numexpr.evaluate(expression, local_dict=arrays)
+    else:
+        namespace = dict(_FUNCTIONS)
+        namespace['__builtins__'] = {}
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            result = eval(expression, namespace, arrays)
+    return numpy.asarray(result, dtype='f4')
+
+
+def band_math(expression, bands, out_path, n_workers=None, cache=None):
+    """Evaluate a band-math expression over whole rasters, block by block.
+
+    ``bands`` maps each name in the expression to a path or URL, e.g.
+    ``{'red': URL + BAND.format(4), 'nir': URL + BAND.format(5)}``; the
+    inputs must share a grid.  The output is a tiled float32 GeoTIFF with
+    the first input's block size, so each output block is computed from
+    one aligned window of every input.  Blocks are read and evaluated in
+    a pool of ``n_workers`` threads, each with its own dataset handles,
+    and written by the calling thread as they finish.  Pixels where any
+    input equals its nodata value are NaN.
+
+    Memory use is a few blocks per thread, so full-resolution scenes don't
+    need an overview to fit in memory.  With a ``BlockCache``, inputs are
+    read through ``CachedReader``, so repeated runs over the same scene
+    only fetch each block once.  Returns ``out_path``.
+    """
+    names = sorted(bands)
+    with rasterio.Env(**REMOTE_OPTIONS), rasterio.open(bands[names[0]]) as src:
+        profile = src.profile.copy()
+        block_shapes = src.block_shapes[0]
+        for name in names[1:]:
+            with rasterio.open(bands[name]) as other:
+                if (other.shape != src.shape or
+                        other.transform != src.transform):
+                    raise ValueError('{} is not on the grid of {}'.format(
+                        bands[name], bands[names[0]]))
+    block_y, block_x = block_shapes
+    # Striped inputs get square output tiles; GeoTIFF tiles are multiples
+    # of 16 pixels.
+    if not profile.get('tiled') or block_x % 16 or block_y % 16:
+        block_x = block_y = 512
+    profile.update(driver='GTiff', dtype='float32', count=1,
+                   nodata=float('nan'), tiled=True, blockxsize=block_x,
+                   blockysize=block_y, compress='deflate', predictor=3,
+                   BIGTIFF='IF_SAFER')
+
+    # rasterio dataset handles are not thread safe: one set per thread.
+    local = threading.local()
+
+    def calc_block(window):
+        arrays = {}
+        invalid = numpy.zeros((window.height, window.width), dtype=bool)
+        with rasterio.Env(**REMOTE_OPTIONS):
+            if not hasattr(local, 'srcs'):
+                if cache is None:
+                    local.srcs = dict((name, rasterio.open(bands[name]))
+                                      for name in names)
+                else:
+                    local.srcs = dict(
+                        (name, CachedReader(bands[name], cache))
+                        for name in names)
+            for name in names:
+                src = local.srcs[name]
+                arrays[name] = src.read(1, window=window)
+                if src.nodata is not None:
+                    invalid |= arrays[name] == src.nodata
+        result = evaluate(expression, arrays)
+        result[invalid] = numpy.nan
+        return window, result
+
+    with rasterio.open(out_path, 'w', **profile) as dst:
+        windows = [window for ij, window in dst.block_windows(1)]
+        pool = ThreadPool(n_workers)
+        try:
+            for window, result in pool.imap_unordered(calc_block, windows):
+                dst.write(result, 1, window=window)
+        finally:
+            pool.close()
+            pool.join()
+    return out_path
+
+
+def index_change(dates, out_path, expression='ndvi', pairs=None, labels=None,
+                 bins=None, resampling=Resampling.bilinear, n_workers=None):
+    """Difference a spectral index between dates, block by block.
+
+    ``dates`` is a list of ``bands`` dicts as for ``band_math``, one per
+    date, in time order.  Every band is wrapped in a ``WarpedVRT`` on the
+    grid of the first date's first band, so dates on different grids are
+    aligned lazily, only for the windows that are read.  For each output
+    block, the matching window of every band of every date is read, the
+    index is evaluated for each date, and each (earlier, later) pair in
+    ``pairs`` (default: consecutive dates) is differenced as later minus
+    earlier.  Zero or nodata inputs make that date's index NaN.  Blocks
+    are processed in a pool of ``n_workers`` threads and written as they
+    finish, so memory use is bounded at any scene size.
+
+    Writes a float32 GeoTIFF with one band per pair, plus histograms of
+    each date's index and each pair's change (``bins`` edges, default 0.05
+    wide over [-2, 2]) to ``<out_path>.csv``.  Returns a dict with
+    ``bins``, ``index_hist`` (dates x bins), ``change_hist`` (pairs x bins)
+    and ``change_mean`` (mean change per pair).
+    """
+    if pairs is None:
+        pairs = [(n, n + 1) for n in range(len(dates) - 1)]
+    if labels is None:
+        labels = ['date{}'.format(n) for n in range(len(dates))]
+    if bins is None:
+        bins = numpy.linspace(-2, 2, 81)
+    names = sorted(dates[0])
+    with rasterio.Env(**REMOTE_OPTIONS), \
+            rasterio.open(dates[0][names[0]]) as ref:
+        profile = ref.profile.copy()
+        grid = {'crs': ref.crs, 'transform': ref.transform,
+                'width': ref.width, 'height': ref.height}
+    profile.update(driver='GTiff', dtype='float32', count=len(pairs),
+                   nodata=float('nan'), tiled=True, blockxsize=512,
+                   blockysize=512, compress='deflate', predictor=3,
+                   BIGTIFF='IF_SAFER')
+
+    # rasterio dataset handles are not thread safe: one set per thread.
+    local = threading.local()
+
+    def open_vrt(path):
+        src = rasterio.open(path)
+        nodata = src.nodata if src.nodata is not None else 0
+        return WarpedVRT(src, resampling=resampling, nodata=nodata, **grid)
+
+    def calc_block(window):
+        with rasterio.Env(**REMOTE_OPTIONS):
+            if not hasattr(local, 'vrts'):
+                local.vrts = [dict((name, open_vrt(bands[name]))
+                                   for name in names) for bands in dates]
+            index_list = []
+            for vrts in local.vrts:
+                arrays = {}
+                invalid = numpy.zeros((window.height, window.width),
+                                      dtype=bool)
+                for name in names:
+                    arrays[name] = vrts[name].read(1, window=window)
+                    invalid |= arrays[name] == vrts[name].nodata
+                index = evaluate(expression, arrays)
+                index[invalid] = numpy.nan
+                index_list.append(index)
+        change = numpy.array([index_list[j] - index_list[i]
+                              for i, j in pairs])
+        index_hist = [numpy.histogram(index[numpy.isfinite(index)], bins)[0]
+                      for index in index_list]
+        finite = [numpy.isfinite(c) for c in change]
+        change_hist = [numpy.histogram(c[f], bins)[0]
+                       for c, f in zip(change, finite)]
+        change_sum = [(c[f].sum(dtype='f8'), f.sum())
+                      for c, f in zip(change, finite)]
+        return window, change, index_hist, change_hist, change_sum
+
+    index_hist = numpy.zeros((len(dates), len(bins) - 1), dtype='i8')
+    change_hist = numpy.zeros((len(pairs), len(bins) - 1), dtype='i8')
+    change_sum = numpy.zeros((len(pairs), 2))
+    with rasterio.open(out_path, 'w', **profile) as dst:
+        for n, (i, j) in enumerate(pairs):
+            dst.set_band_description(
+                n + 1, '{} - {}'.format(labels[j], labels[i]))
+        windows = [window for ij, window in dst.block_windows(1)]
+        pool = ThreadPool(n_workers)
+        try:
+            for window, change, i_hist, c_hist, c_sum in pool.imap_unordered(
+                    calc_block, windows):
+                dst.write(change, window=window)
+                index_hist += i_hist
+                change_hist += c_hist
+                change_sum += c_sum
+        finally:
+            pool.close()
+            pool.join()
+
+    change_mean = change_sum[:, 0] / numpy.maximum(change_sum[:, 1], 1)
+    with open(os.path.splitext(out_path)[0] + '.csv', 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['bin_min', 'bin_max'] +
+                        ['{} {}'.format(label, expression)
+                         for label in labels] +
+                        ['{} - {}'.format(labels[j], labels[i])
+                         for i, j in pairs])
+        for n in range(len(bins) - 1):
+            writer.writerow([bins[n], bins[n + 1]] +
+                            list(index_hist[:, n]) + list(change_hist[:, n]))
+    return {'bins': bins, 'index_hist': index_hist,
+            'change_hist': change_hist, 'change_mean': change_mean}
+
+
+if __name__ == '__main__':
+    # Fresno, CA in the full-resolution red band
+    with rasterio.Env(**REMOTE_OPTIONS), \
+            rasterio.open(URL + BAND.format(4)) as src:
+        row, col = lonlat_to_rowcol(src, [-119.770163586], [36.741997032])
+        print('Fresno row,col=({},{})'.format(row[0], col[0]))
+    print(CACHE_STATS)
+
+    # Full-resolution NDVI, written block by block.  Blocks are cached
+    # locally, so running this again doesn't download the scene again.
+    cache = BlockCache('landsat_blocks')
+    out_path = band_math('ndvi', {'red': URL + BAND.format(BANDS['red']),
+                                  'nir': URL + BAND.format(BANDS['nir'])},
+                         BAND.format('NDVI'), cache=cache)
+    print('Wrote {}'.format(out_path))
+    print(cache.stats)
+    values, valid = sample_points(out_path, [-119.770163586], [36.741997032])
+    print('Fresno NDVI={}'.format(values[0] if valid[0] else 'nodata'))
+
+    # Full-resolution NDVI change from 2017-06-16 to 2018-06-19
+    dates = [dict((name, url + band.format(BANDS[name]))
+                  for name in ('red', 'nir'))
+             for url, band in ((URL, BAND), (URL2, BAND2))]
+    summary = index_change(dates, BAND2.format('NDVI_CHANGE'),
+                           labels=['2017-06-16', '2018-06-19'])
+    print('Mean NDVI change={:.3f}'.format(summary['change_mean'][0]))
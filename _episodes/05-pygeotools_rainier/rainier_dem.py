@@ -1,159 +1,1560 @@
 #! /usr/bin/env python
 
-from osgeo import gdal
+import os
+import sys
+import argparse
+
+from osgeo import gdal, ogr, osr
 import numpy as np
 import matplotlib.pyplot as plt
 
 from pygeotools.lib import iolib, warplib, geolib, timelib, malib
 
-#Function to generate a 3-panel plot for input arrays
-def plot3panel(dem_list, clim=None, titles=None, cmap='inferno', label=None, overlay=None, fn=None):
-    fig, axa = plt.subplots(1,3, sharex=True, sharey=True, figsize=(10,5))
-    alpha = 1.0
-    for n, ax in enumerate(axa):
-        #Gray background
-        ax.set_facecolor('0.5')
-        #Force aspect ratio to match images
-        ax.set(adjustable='box-forced', aspect='equal')
-        #Turn off axes labels/ticks
-        ax.get_xaxis().set_visible(False)
-        ax.get_yaxis().set_visible(False)
-        if titles is not None:
-            ax.set_title(titles[n])
-        #Plot background shaded relief map
+#Decimation factor needed to fit an array of this shape within max_size pixels on each side
+def preview_factor(shape, max_size):
+    return max(1, int(np.ceil(max(shape) / float(max_size))))
+
+#Strided (nearest) downsample of an in-memory array for display, a view with no copy
+def downsample(a, max_size):
+    f = preview_factor(a.shape, max_size)
+    return a[::f, ::f]
+
+#Downsample each array in a list, one at a time for a PackedMaskedList so only one full mask is ever unpacked
+def downsample_list(a_list, max_size):
+    if isinstance(a_list, PackedMaskedList):
+        return [a_list.downsample(n, max_size) for n in range(len(a_list))]
+    return [downsample(a, max_size) for a in a_list]
+
+#Read a preview of a raster band no larger than max_size pixels on a side
+#Uses the coarsest existing overview that still has at least the target resolution, building overviews
+#on the fly if requested and none are suitable, so a quicklook of a huge DEM only reads a few MB
+def ds_getma_preview(ds, max_size=1024, bnum=1, build=False):
+    b = ds.GetRasterBand(bnum)
+    ndv = b.GetNoDataValue()
+    f = preview_factor((ds.RasterYSize, ds.RasterXSize), max_size)
+    out_shape = (int(np.ceil(ds.RasterYSize / float(f))), int(np.ceil(ds.RasterXSize / float(f))))
+    if f > 1:
+        ovr_list = [b.GetOverview(i) for i in range(b.GetOverviewCount())]
+        ovr_list = [o for o in ovr_list if o.XSize >= out_shape[1] and o.YSize >= out_shape[0]]
+        if not ovr_list and build and f >= 2:
+            #Power-of-two levels down to the target size; read-only datasets get an external .ovr
+            levels = [2**i for i in range(1, int(np.log2(f))+1)]
+            ds.BuildOverviews('NEAREST', levels)
+            ovr_list = [b.GetOverview(i) for i in range(b.GetOverviewCount())]
+            ovr_list = [o for o in ovr_list if o.XSize >= out_shape[1] and o.YSize >= out_shape[0]]
+        if ovr_list:
+            b = min(ovr_list, key=lambda o: o.XSize * o.YSize)
+    #Decimated read of the selected band (GDAL also picks a suitable overview itself when reading the full-res band)
+    a = np.ma.masked_invalid(b.ReadAsArray(buf_xsize=out_shape[1], buf_ysize=out_shape[0]))
+    if ndv is not None:
+        a = np.ma.masked_equal(a, ndv)
+    return a
+
+#Reusable multi-panel figure for a list of input arrays
+#The figure, axes, images and colorbar are created on the first render(), and later calls only
+#swap image data in place (set_data), so rendering many products or regions avoids rebuilding the figure
+class Plot3Panel(object):
+    def __init__(self, n=3, figsize=(10,5)):
+        self.fig, self.axa = plt.subplots(1, n, sharex=True, sharey=True, figsize=figsize, squeeze=False)
+        self.axa = self.axa[0]
+        for ax in self.axa:
+            #Gray background
+            ax.set_facecolor('0.5')
+            #Force aspect ratio to match images
+            ax.set(adjustable='box-forced', aspect='equal')
+            #Turn off axes labels/ticks
+            ax.get_xaxis().set_visible(False)
+            ax.get_yaxis().set_visible(False)
+        self.im_list = None
+        self.ov_list = None
+        self.cbar = None
+
+    #Largest useful image size (pixels) for one panel at this dpi
+    def panel_size(self, dpi):
+        w, h = self.fig.get_size_inches()
+        return int(max(w / len(self.axa), h) * dpi)
+
+    def render(self, dem_list, clim=None, titles=None, cmap='inferno', label=None, overlay=None, fn=None, dpi=150):
+        if len(dem_list) != len(self.axa):
+            raise ValueError('Got %i arrays for a %i-panel figure' % (len(dem_list), len(self.axa)))
+        alpha = 1.0 if overlay is None else 0.7
+        #No point pushing more pixels into imshow than the output can show
+        max_size = self.panel_size(dpi)
+        dem_list = downsample_list(dem_list, max_size)
         if overlay is not None:
-            alpha = 0.7
-            axa[n].imshow(overlay[n], cmap='gray', clim=(1,255)) 
-    #Plot each array 
-    im_list = [axa[i].imshow(dem_list[i], clim=clim, cmap=cmap, alpha=alpha) for i in range(len(dem_list))]
-    fig.tight_layout()
-    fig.colorbar(im_list[0], ax=axa.ravel().tolist(), label=label, extend='both', shrink=0.5)
-    if fn is not None:
-        fig.savefig(fn, bbox_inches='tight', pad_inches=0, dpi=150)
-
-#Input DEM filenames
-dem_1970_fn = '19700901_ned1_2003_adj_warp.tif'
-dem_2008_fn = '20080901_rainierlidar_10m-adj.tif'
-dem_2015_fn = '20150818_rainier_summer-tile-0.tif'
-dem_fn_list = [dem_1970_fn, dem_2008_fn, dem_2015_fn]
-
-#This will return warped, in-memory GDAL dataset objects
-#Can also resample all inputs to a lower resolution (res=256)
-ds_list = warplib.memwarp_multi_fn(dem_fn_list, extent='intersection', res='min', t_srs=dem_2015_fn)
-
-#Load datasets to NumPy arrays
-dem_1970, dem_2008, dem_2015 = [iolib.ds_getma(i) for i in ds_list]
-dem_list = [dem_1970, dem_2008, dem_2015]
-#dem_list = [iolib.ds_getma(i) for i in ds_list]
-
-titles = ['1970', '2008', '2015']
-clim = malib.calcperc(dem_list[0], (2,98))
-plot3panel(dem_list, clim, titles, 'inferno', 'Elevation (m WGS84)', fn='dem.png')
-
-#ddem_1970_2015 = dem_1970 - dem_2015
-#ddem_2008_2015 = dem_2008 - dem_2015
-#ddem_1970_2008 = dem_1970 - dem_2008
-
-#Extract timestamps from filenames
-t_list = np.array([timelib.fn_getdatetime(fn) for fn in dem_fn_list])
-#Compute time differences, convert decimal years
-dt_list = [timelib.timedelta2decyear(d) for d in np.diff(t_list)]
-dt_list.append(dt_list[0]+dt_list[1])
-
-#Calculate elevation difference for each time period 
-dh_list = [dem_2008 - dem_1970, dem_2015 - dem_2008, dem_2015 - dem_1970]
-titles = ['1970 to 2008 (%0.1f yr)' % dt_list[0], '2008 to 2015 (%0.1f yr)' % dt_list[1], '1970 to 2015 (%0.1f yr)' % dt_list[2]]
-plot3panel(dh_list, (-30, 30), titles, 'RdBu', 'Elevation Change (m)', fn='dem_dh.png')
-
-#Calculate annual rate of change
-dhdt_list = np.ma.array(dh_list)/np.array(dt_list)[:,np.newaxis,np.newaxis]
-plot3panel(dhdt_list, (-2, 2), titles, 'RdBu', 'Elevation Change Rate (m/yr)', fn='dem_dhdt.png')
-
-#Hmmm, strange positive signals over trees for some of these.  Are they growing 3 m/yr?  That would be exciting, but probably not.  Looks like our 1970 and 2008 DEMs were "bare-ground" digital terrain models (DTMs), while the 2015 DEM was a digital surface model (DSM) that included vegetation.
-#Let's clip our map to the glaciers using polygons from the Randolph Glacier Inventory (RGI)
-shp_fn = 'rgi60_glacierpoly_rainier.shp'
-#Create binary mask from polygon shapefile to match our warped raster datasets
-shp_mask = geolib.shp2array(shp_fn, ds_list[0])
-#Now apply the mask to each array 
-dhdt_list_shpclip = [np.ma.array(dhdt, mask=shp_mask) for dhdt in dhdt_list]
-plot3panel(dhdt_list_shpclip, (-2, 2), titles, 'RdBu', 'Elevation Change Rate (m/yr)', fn='dem_dhdt_shpclip.png')
-
-#That looks pretty good, but context would be nice.
-#Let's generate some shaded relief basemaps using gdaldem API functionality
-dem_1970_hs_ds = gdal.DEMProcessing('', ds_list[0], 'hillshade', format='MEM')
-dem_1970_hs = iolib.ds_getma(dem_1970_hs_ds)
-dem_2008_hs_ds = gdal.DEMProcessing('', ds_list[1], 'hillshade', format='MEM')
-dem_2008_hs = iolib.ds_getma(dem_2008_hs_ds)
-hs_list = [dem_1970_hs, dem_2008_hs, dem_1970_hs]
-
-#Plot our clipped rates over shaded relief maps
-plot3panel(dhdt_list_shpclip, (-2, 2), titles, 'RdBu', 'Elevation Change Rate (m/yr)', overlay=hs_list, fn='dem_dhdt_shpclip_hs.png')
-
-#OK, so we have elevation change, what about volume and mass change during different periods? 
-#Extract x and y pixel resolution (m) from geotransform
-gt = ds_list[0].GetGeoTransform()
-px_res = (gt[1], -gt[5])
-#Calculate pixel area in m^2
-px_area = px_res[0]*px_res[0]
-dhdt_list_shpclip = np.ma.array(dhdt_list_shpclip).reshape(len(dhdt_list_shpclip), dhdt_list_shpclip[0].shape[0]*dhdt_list_shpclip[1].shape[1])
-#Now, lets multiple pixel area by the observed elevation change for all valid pixels over glaciers
-dhdt_mean = dhdt_list_shpclip.mean(axis=1)
-#Compute area in km^2
-area_total = px_area * dhdt_list_shpclip.count(axis=1) / 1E6
-#Volume change rate in km^3/yr
-vol_rate = dhdt_mean * area_total / 1E3
-#Volume change in km^3
-vol_total = vol_rate * dt_list 
-#Assume intermediate density between ice and snow for volume change (Gt)
-rho = 0.850
-mass_rate = vol_rate * rho
-mass_total = vol_total * rho
-
-#Print some numbers (clean this up)
-out = zip(titles, dhdt_mean, area_total, vol_rate, vol_total, mass_rate, mass_total)
-for i in out:
-    print(i[0])
-    print('%0.2f m/yr mean elevation change rate' % i[1])
-    print('%0.2f km^2 total area' % i[2])
-    print('%0.2f km^3/yr mean volume change rate' % i[3])
-    print('%0.2f km^3 total volume change' % i[4])
-    print('%0.2f km^3/yr mean mass change rate' % i[5])
-    print('%0.2f km^3 total mass change' % i[6])
-    print('\n')
-
-def plot_2dhist(ax, x, y, xlim, ylim, log=False):
-    bins = (100, 100)
-    common_mask = ~(malib.common_mask([x,y]))
-    x = x[common_mask]
-    y = y[common_mask]
-    H, xedges, yedges = np.histogram2d(x,y,range=[xlim,ylim],bins=bins)
-    H = np.rot90(H)
-    H = np.flipud(H)
-    Hmasked = np.ma.masked_where(H==0,H)
-    Hmed_idx = np.ma.argmax(Hmasked, axis=0)
-    ymax = (yedges[:-1]+np.diff(yedges))[Hmed_idx]
-    #Hmasked = H
+            overlay = downsample_list(overlay, max_size)
+        if self.im_list is None:
+            #Background shaded relief images sit underneath, hidden until an overlay is passed
+            self.ov_list = [ax.imshow(dem_list[n], cmap='gray', clim=(1,255), visible=False) for n, ax in enumerate(self.axa)]
+            #Plot each array
+            self.im_list = [ax.imshow(dem_list[n], clim=clim, cmap=cmap, alpha=alpha) for n, ax in enumerate(self.axa)]
+            self.fig.tight_layout()
+            self.cbar = self.fig.colorbar(self.im_list[0], ax=self.axa.ravel().tolist(), label=label, extend='both', shrink=0.5)
+        for n, ax in enumerate(self.axa):
+            im = self.im_list[n]
+            extent = (-0.5, dem_list[n].shape[1]-0.5, dem_list[n].shape[0]-0.5, -0.5)
+            im.set_data(dem_list[n])
+            im.set_extent(extent)
+            im.set_cmap(cmap)
+            im.set_alpha(alpha)
+            if clim is None:
+                im.autoscale()
+            else:
+                im.set_clim(clim)
+            ov = self.ov_list[n]
+            ov.set_visible(overlay is not None)
+            if overlay is not None:
+                ov.set_data(overlay[n])
+                ov.set_extent(extent)
+            ax.set_xlim(extent[0], extent[1])
+            ax.set_ylim(extent[2], extent[3])
+            ax.set_title(titles[n] if titles is not None else '')
+        self.cbar.set_label(label if label is not None else '')
+        self.cbar.update_normal(self.im_list[0])
+        if fn is not None:
+            self.fig.savefig(fn, bbox_inches='tight', pad_inches=0, dpi=dpi)
+        return self
+
+#Per-process renderers for batch mode and render_batch, one per panel count
+_batch_renderers = {}
+
+def batch_renderer(n):
+    if n not in _batch_renderers:
+        _batch_renderers[n] = Plot3Panel(n)
+    return _batch_renderers[n]
+
+#Function to generate a 3-panel plot for input arrays
+#Pass a Plot3Panel as renderer to reuse its figure, or batch=True to reuse this process's figure for
+#the same number of panels, otherwise a new figure is created
+def plot3panel(dem_list, clim=None, titles=None, cmap='inferno', label=None, overlay=None, fn=None, renderer=None, batch=False):
+    if renderer is None:
+        renderer = batch_renderer(len(dem_list)) if batch else Plot3Panel(len(dem_list))
+    return renderer.render(dem_list, clim, titles, cmap, label, overlay, fn)
+
+#Render one job: a dict with 'fn_list' ([filename, band] per panel), 'fn' (output png),
+#and optional 'overlay' (same form as fn_list) and plot3panel keywords ('clim', 'titles', 'cmap', 'label')
+def _render_job(job):
+    renderer = batch_renderer(len(job['fn_list']))
+    #Only read as many pixels as the output can show
+    max_size = renderer.panel_size(150)
+    dem_list = [ds_getma_preview(gdal.Open(fn), max_size, bnum, build=True) for fn, bnum in job['fn_list']]
+    overlay = None
+    if job.get('overlay') is not None:
+        overlay = [ds_getma_preview(gdal.Open(fn), max_size, bnum, build=True) for fn, bnum in job['overlay']]
+    renderer.render(dem_list, job.get('clim'), job.get('titles'), job.get('cmap', 'inferno'), \
+            job.get('label'), overlay, job['fn'])
+    return job['fn']
+
+#Headless rendering of many 3-panel figures (e.g., one per region) across a pool of worker processes
+#Each worker keeps a single Agg figure and reuses it for every job it receives
+def render_batch(job_list, nproc=1):
+    plt.switch_backend('Agg')
+    if nproc > 1:
+        import multiprocessing
+        #Workers started with spawn or forkserver reimport this module with the default backend, so switch them too
+        pool = multiprocessing.Pool(nproc, initializer=plt.switch_backend, initargs=('Agg',))
+        for fn in pool.imap_unordered(_render_job, job_list):
+            print('Wrote %s' % fn)
+        pool.close()
+        pool.join()
+    else:
+        for job in job_list:
+            print('Wrote %s' % _render_job(job))
+
+#Fixed-bin 2D histogram with integer counts (plus optional weight sums), accumulated block by block
+#Each update() computes bin indices directly from the edges and adds them with a single np.bincount,
+#without building filtered copies of x and y.  Partial histograms from parallel workers combine with merge()
+class Hist2D(object):
+    def __init__(self, xlim, ylim, bins=(100, 100)):
+        self.xlim = xlim
+        self.ylim = ylim
+        self.bins = bins
+        self.xedges = np.linspace(xlim[0], xlim[1], bins[0]+1)
+        self.yedges = np.linspace(ylim[0], ylim[1], bins[1]+1)
+        self.xcenters = (self.xedges[:-1] + self.xedges[1:]) / 2.
+        self.ycenters = (self.yedges[:-1] + self.yedges[1:]) / 2.
+        #Indexed [xbin, ybin], like np.histogram2d
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.weights = np.zeros(bins)
+
+    #Flat bin index for each pixel, with out-of-range or masked pixels sent to an overflow bin
+    def _bin_index(self, x, y):
+        nx, ny = self.bins
+        xd = np.ma.getdata(x)
+        yd = np.ma.getdata(y)
+        valid = ~(np.ma.getmaskarray(x) | np.ma.getmaskarray(y))
+        with np.errstate(invalid='ignore'):
+            valid &= (xd >= self.xlim[0]) & (xd <= self.xlim[1]) & (yd >= self.ylim[0]) & (yd <= self.ylim[1])
+            xi = np.clip(((xd - self.xlim[0]) * (nx / float(self.xlim[1] - self.xlim[0]))), 0, nx-1).astype(np.intp)
+            yi = np.clip(((yd - self.ylim[0]) * (ny / float(self.ylim[1] - self.ylim[0]))), 0, ny-1).astype(np.intp)
+        return np.where(valid, xi*ny + yi, nx*ny).ravel()
+
+    def update(self, x, y, w=None):
+        nx, ny = self.bins
+        idx = self._bin_index(x, y)
+        self.counts += np.bincount(idx, minlength=nx*ny+1)[:-1].reshape(self.bins)
+        if w is not None:
+            self.weights += np.bincount(idx, weights=np.ma.filled(w, 0).ravel(), minlength=nx*ny+1)[:-1].reshape(self.bins)
+        return self
+
+    #Update from full 2D arrays in row chunks, to bound temporary memory
+    def update_chunks(self, x, y, w=None, nrows=1024):
+        for r in range(0, x.shape[0], nrows):
+            sl = slice(r, r + nrows)
+            self.update(x[sl], y[sl], None if w is None else w[sl])
+        return self
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.weights += other.weights
+        return self
+
+    #Most common y for each x bin (NaN for empty columns)
+    def mode_line(self):
+        out = self.ycenters[np.argmax(self.counts, axis=1)]
+        return np.where(self.counts.sum(axis=1) > 0, out, np.nan)
+
+    #q-th percentile of y for each x bin, from the cumulative counts (NaN for empty columns)
+    def percentile_line(self, q):
+        c = np.cumsum(self.counts, axis=1)
+        total = c[:,-1]
+        idx = np.argmax(c >= (q / 100.) * total[:,np.newaxis], axis=1)
+        return np.where(total > 0, self.ycenters[idx], np.nan)
+
+    def median_line(self):
+        return self.percentile_line(50)
+
+#Plot a Hist2D of y (e.g., dh/dt) vs. x (e.g., elevation) with the mode line, or build one from x and y
+def plot_2dhist(ax, x=None, y=None, xlim=None, ylim=None, log=False, hist=None):
+    if hist is None:
+        hist = Hist2D(xlim, ylim).update_chunks(x, y)
+    #Rows are y bins, columns are x bins
+    Hmasked = np.ma.masked_equal(hist.counts.T, 0)
     H_clim = malib.calcperc(Hmasked, (2,98))
     if log:
         import matplotlib.colors as colors
-        ax.pcolormesh(xedges,yedges,Hmasked,cmap='inferno',norm=colors.LogNorm(vmin=H_clim[0],vmax=H_clim[1]))
+        ax.pcolormesh(hist.xedges,hist.yedges,Hmasked,cmap='inferno',norm=colors.LogNorm(vmin=H_clim[0],vmax=H_clim[1]))
+    else:
+        ax.pcolormesh(hist.xedges,hist.yedges,Hmasked,cmap='inferno',vmin=H_clim[0],vmax=H_clim[1])
+    ax.plot(hist.xcenters, hist.mode_line(), color='dodgerblue',lw=1.0)
+
+#Stacked elevation change rate vs. elevation plots, one panel per Hist2D
+def plot_dem_vs_dhdt(hist_list, titles, fn=None):
+    f, axa = plt.subplots(len(hist_list), sharex=True, sharey=True, squeeze=False)
+    axa = axa[:,0]
+    for ax, hist, title in zip(axa, hist_list, titles):
+        plot_2dhist(ax, hist=hist)
+        ax.set_title(title)
+        ax.set_ylabel('Elev. Change Rate (m/yr)')
+        ax.axhline(0,lw=0.5,ls='-',c='r',alpha=0.5)
+    axa[-1].set_xlabel('Elevation (m WGS84)')
+    f.tight_layout()
+    if fn is not None:
+        f.savefig(fn, bbox_inches='tight', pad_inches=0, dpi=150)
+    return f
+
+#Median of each group of values, where values are sorted within contiguous groups given by starts and counts
+def _group_median(values, starts, counts):
+    lo = values[starts + (counts - 1) // 2]
+    hi = values[starts + counts // 2]
+    return (lo + hi) / 2.
+
+#Hypsometric statistics of y (e.g., dh/dt) in elevation bins of z, for each nonzero label (e.g., glacier)
+#Bins are assigned with np.digitize and combined with labels into a single key, so count and mean come from np.bincount,
+#and exact median and NMAD come from one lexsort of the valid pixels, with no Python loop over glaciers or bins
+#Returns a dict of 1D arrays (label, zbin, count, mean, median, nmad), one entry per nonempty label/bin
+def hypso_stats(z, y, labels, z_edges):
+    nb = len(z_edges) - 1
+    valid = ~(np.ma.getmaskarray(z) | np.ma.getmaskarray(y)) & (np.asarray(labels) > 0)
+    zbin = np.digitize(np.ma.getdata(z)[valid], z_edges) - 1
+    x = np.ma.getdata(y)[valid].astype(np.float64)
+    lab = np.asarray(labels)[valid].astype(np.int64)
+    inbin = (zbin >= 0) & (zbin < nb)
+    key = lab[inbin] * nb + zbin[inbin]
+    x = x[inbin]
+    #Sort by key, then by value within each key
+    order = np.lexsort((x, key))
+    key = key[order]
+    x = x[order]
+    ukey, starts, counts = np.unique(key, return_index=True, return_counts=True)
+    mean = np.bincount(np.repeat(np.arange(ukey.size), counts), weights=x) / counts
+    median = _group_median(x, starts, counts)
+    #Normalized median absolute deviation, a robust estimate of spread
+    absdev = np.abs(x - np.repeat(median, counts))
+    absdev = absdev[np.lexsort((absdev, key))]
+    nmad = 1.4826 * _group_median(absdev, starts, counts)
+    return {'label':ukey // nb, 'zbin':ukey % nb, 'count':counts, 'mean':mean, 'median':median, 'nmad':nmad}
+
+#Write a tidy hypsometry table (one row per period, glacier and elevation bin) of dh/dt count, mean, median and NMAD
+#Rows for 'All' aggregate every labeled pixel in the region
+def write_hypso_csv(out_fn, titles, dem_list, dhdt_list, pair_list, labels, names, z_edges):
+    import csv
+    with open(out_fn, 'w') as f:
+        w = csv.writer(f)
+        w.writerow(['period', 'glacier', 'z_min', 'z_max', 'count', 'dhdt_mean', 'dhdt_median', 'dhdt_nmad'])
+        for title, dhdt, (i, j) in zip(titles, dhdt_list, pair_list):
+            #Elevation at the start of the period
+            for lab, lab_names in ((labels, names), ((labels > 0).astype(np.uint8), ['All'])):
+                h = hypso_stats(dem_list[i], dhdt, lab, z_edges)
+                for n in range(h['count'].size):
+                    w.writerow([title, lab_names[h['label'][n]-1], z_edges[h['zbin'][n]], z_edges[h['zbin'][n]+1], h['count'][n], \
+                            '%0.3f' % h['mean'][n], '%0.3f' % h['median'][n], '%0.3f' % h['nmad'][n]])
+
+#Volume and mass change for each period from mean dh/dt (m/yr) and total area (km^2)
+def calc_volmass(dhdt_mean, area_total, dt_list, rho=0.850):
+    #Volume change rate in km^3/yr
+    vol_rate = dhdt_mean * area_total / 1E3
+    #Volume change in km^3
+    vol_total = vol_rate * dt_list
+    #Assume intermediate density between ice and snow for volume change (Gt)
+    mass_rate = vol_rate * rho
+    mass_total = vol_total * rho
+    return vol_rate, vol_total, mass_rate, mass_total
+
+def print_volmass(titles, dhdt_mean, area_total, dt_list, rho=0.850):
+    vol_rate, vol_total, mass_rate, mass_total = calc_volmass(dhdt_mean, area_total, np.array(dt_list), rho)
+    out = zip(titles, dhdt_mean, area_total, vol_rate, vol_total, mass_rate, mass_total)
+    for i in out:
+        print(i[0])
+        print('%0.2f m/yr mean elevation change rate' % i[1])
+        print('%0.2f km^2 total area' % i[2])
+        print('%0.2f km^3/yr mean volume change rate' % i[3])
+        print('%0.2f km^3 total volume change' % i[4])
+        print('%0.2f km^3/yr mean mass change rate' % i[5])
+        print('%0.2f km^3 total mass change' % i[6])
+        print('\n')
+
+#Streaming sum, count, mean, variance, min and max of valid values, optionally grouped by integer labels
+#Each update() reduces one block with np.bincount, and block results are folded in with the
+#parallel variance update of Chan et al. (1979), which stays numerically stable for billions of values
+#Partial results from different workers can be combined with merge()
+class StreamStats(object):
+    def __init__(self, nlabels=1):
+        self.nlabels = nlabels
+        self.count = np.zeros(nlabels, dtype=np.int64)
+        self.mean = np.zeros(nlabels)
+        self.m2 = np.zeros(nlabels)
+        self.min = np.full(nlabels, np.inf)
+        self.max = np.full(nlabels, -np.inf)
+
+    @property
+    def sum(self):
+        return self.mean * self.count
+
+    def var(self, ddof=0):
+        return np.where(self.count > ddof, self.m2 / np.maximum(self.count - ddof, 1), np.nan)
+
+    def std(self, ddof=0):
+        return np.sqrt(self.var(ddof))
+
+    #Add a block of values (masked array or ndarray), with optional labels array of the same shape
+    def update(self, a, labels=None):
+        valid = ~np.ma.getmaskarray(a)
+        x = np.ma.getdata(a)[valid].astype(np.float64)
+        if labels is None:
+            lab = np.zeros(x.size, dtype=np.intp)
+        else:
+            lab = np.asarray(labels)[valid].astype(np.intp)
+        n = np.bincount(lab, minlength=self.nlabels)
+        mean = np.bincount(lab, weights=x, minlength=self.nlabels) / np.maximum(n, 1)
+        m2 = np.bincount(lab, weights=(x - mean[lab])**2, minlength=self.nlabels)
+        mn = np.full(self.nlabels, np.inf)
+        mx = np.full(self.nlabels, -np.inf)
+        np.minimum.at(mn, lab, x)
+        np.maximum.at(mx, lab, x)
+        self._combine(n, mean, m2, mn, mx)
+        return self
+
+    def merge(self, other):
+        self._combine(other.count, other.mean, other.m2, other.min, other.max)
+        return self
+
+    def _combine(self, n_b, mean_b, m2_b, min_b, max_b):
+        n = self.count + n_b
+        n_safe = np.maximum(n, 1)
+        delta = mean_b - self.mean
+        self.mean = self.mean + delta * n_b / n_safe
+        self.m2 = self.m2 + m2_b + delta**2 * self.count * n_b / n_safe
+        self.count = n
+        self.min = np.minimum(self.min, min_b)
+        self.max = np.maximum(self.max, max_b)
+
+    #Collapse the selected labels (default: all labels except 0, the background) into a single group
+    def combined(self, idx=slice(1, None)):
+        out = StreamStats(1)
+        n = self.count[idx]
+        out.count[0] = n.sum()
+        if out.count[0] > 0:
+            out.mean[0] = (n * self.mean[idx]).sum() / out.count[0]
+            out.m2[0] = (self.m2[idx] + n * (self.mean[idx] - out.mean[0])**2).sum()
+            out.min[0] = self.min[idx].min()
+            out.max[0] = self.max[idx].max()
+        return out
+
+#Number of set bits in each possible byte value
+_popcount = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+#Compact validity mask (True = valid) backed by np.packbits, 1 bit per pixel rather than the 1 byte of a numpy.ma mask
+#AND, OR, NOT and count work directly on the packed bytes, and to_ma() converts to a numpy.ma array at the edges
+class BitMask(object):
+    def __init__(self, bits, shape):
+        self.bits = bits
+        self.shape = tuple(shape)
+        self.size = int(np.prod(self.shape))
+
+    @classmethod
+    def from_bool(cls, valid):
+        valid = np.asarray(valid, dtype=bool)
+        return cls(np.packbits(valid.ravel()), valid.shape)
+
+    @classmethod
+    def from_ma(cls, a):
+        return cls.from_bool(~np.ma.getmaskarray(a))
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def to_bool(self):
+        return np.unpackbits(self.bits, count=self.size).reshape(self.shape).astype(bool)
+
+    #Masked array view of data (no copy of data), masked where not valid
+    def to_ma(self, data):
+        return np.ma.array(data, mask=~self.to_bool(), copy=False)
+
+    #Number of valid pixels
+    def count(self):
+        return int(_popcount[self.bits].sum(dtype=np.int64))
+
+    def __and__(self, other):
+        return BitMask(self.bits & other.bits, self.shape)
+
+    def __or__(self, other):
+        return BitMask(self.bits | other.bits, self.shape)
+
+    def __invert__(self):
+        bits = ~self.bits
+        #Clear the padding bits at the end of the last byte
+        pad = bits.size * 8 - self.size
+        if pad:
+            bits[-1] &= (0xFF << pad) & 0xFF
+        return BitMask(bits, self.shape)
+
+#List-like stack of plain data arrays with packed validity masks
+#Indexing or iterating yields numpy.ma arrays, so consumers of lists of masked arrays work unchanged,
+#but each full-size boolean mask only exists while that layer is in use
+class PackedMaskedList(object):
+    def __init__(self, data_list, valid_list):
+        self.data_list = list(data_list)
+        self.valid_list = list(valid_list)
+
+    def __len__(self):
+        return len(self.data_list)
+
+    def __getitem__(self, n):
+        return self.valid_list[n].to_ma(self.data_list[n])
+
+    #Downsampled masked array of item n, with only the downsampled copy of its mask kept
+    def downsample(self, n, max_size):
+        valid = downsample(self.valid_list[n].to_bool(), max_size).copy()
+        return np.ma.array(downsample(self.data_list[n], max_size), mask=~valid, copy=False)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+#Scratch directory of uncompressed .npy layers, opened as np.memmap, each with its packed validity mask alongside
+#Layers come back as read-only memory maps, so large intermediates are paged by the OS instead of living in the process heap
+#A layer only counts as stored once it is listed in manifest.json (replaced atomically), so a crashed run resumes from the
+#completed layers. key identifies the inputs and grid, and a different key discards the stored layers
+class ScratchStore(object):
+    def __init__(self, scratchdir, key):
+        import json
+        self.scratchdir = scratchdir
+        if not os.path.exists(scratchdir):
+            os.makedirs(scratchdir)
+        self.manifest_fn = os.path.join(scratchdir, 'manifest.json')
+        self.manifest = {}
+        if os.path.exists(self.manifest_fn):
+            with open(self.manifest_fn) as f:
+                self.manifest = json.load(f)
+        if self.manifest.get('key') != key:
+            self.manifest = {'key':key, 'layers':[]}
+            self._save_manifest()
+
+    def _save_manifest(self):
+        import json
+        tmp_fn = self.manifest_fn + '.tmp'
+        with open(tmp_fn, 'w') as f:
+            json.dump(self.manifest, f)
+        #os.replace also overwrites an existing manifest on Windows
+        os.replace(tmp_fn, self.manifest_fn)
+
+    def __contains__(self, name):
+        return name in self.manifest['layers']
+
+    def _fn(self, name, suffix=''):
+        return os.path.join(self.scratchdir, name + suffix + '.npy')
+
+    #Read-only memory map of a stored layer, and its BitMask
+    def load(self, name):
+        data = np.load(self._fn(name), mmap_mode='r')
+        return data, BitMask(np.load(self._fn(name, '_valid')), data.shape)
+
+    #Stored layer if present, otherwise fill a new memory map in place with func(out), store it with valid and return it
+    def get(self, name, func, valid, dtype=np.float32):
+        if name not in self:
+            out = np.lib.format.open_memmap(self._fn(name), mode='w+', dtype=dtype, shape=valid.shape)
+            func(out)
+            out.flush()
+            del out
+            np.save(self._fn(name, '_valid'), valid.bits)
+            self.manifest['layers'].append(name)
+            self._save_manifest()
+        return self.load(name)
+
+#Reduce each layer of a stack (list of 2D masked arrays) into a StreamStats, in row chunks
+#Only the valid values of one chunk are ever copied, so there is no full-stack reshape or copy
+def reduce_stack(stack, labels=None, nlabels=1, nrows=1024):
+    stats_list = []
+    for a in stack:
+        stats = StreamStats(nlabels)
+        for r in range(0, a.shape[0], nrows):
+            sl = slice(r, r + nrows)
+            stats.update(a[sl], None if labels is None else labels[sl])
+        stats_list.append(stats)
+    return stats_list
+
+#Generate (xoff, yoff, xsize, ysize) windows that follow the natural block size of the dataset
+#Strip-organized datasets (including MEM) have 1-row blocks, so these are grouped into taller windows
+def block_windows(ds, bs=None, min_rows=256):
+    if bs is None:
+        bs = ds.GetRasterBand(1).GetBlockSize()
+    bx, by = bs
+    by = max(by, min_rows)
+    for yoff in range(0, ds.RasterYSize, by):
+        ysize = min(by, ds.RasterYSize - yoff)
+        for xoff in range(0, ds.RasterXSize, bx):
+            xsize = min(bx, ds.RasterXSize - xoff)
+            yield (xoff, yoff, xsize, ysize)
+
+#Read a single window as a masked array, masking NoData and NaN
+def ds_getma_win(ds, win, bnum=1):
+    b = ds.GetRasterBand(bnum)
+    a = np.ma.masked_invalid(b.ReadAsArray(*win))
+    ndv = b.GetNoDataValue()
+    if ndv is not None:
+        a = np.ma.masked_equal(a, ndv)
+    return a
+
+#Create an empty tiled, compressed GeoTIFF on the same grid as r_ds
+def create_like(r_ds, out_fn, nbands=1, dtype=gdal.GDT_Float32, ndv=-9999):
+    #Compress with all cores so the single writer keeps up with parallel tile workers
+    opt = iolib.gdal_opt + ['NUM_THREADS=ALL_CPUS']
+    out_ds = iolib.gtif_drv.Create(out_fn, r_ds.RasterXSize, r_ds.RasterYSize, nbands, dtype, options=opt)
+    out_ds.SetGeoTransform(r_ds.GetGeoTransform())
+    out_ds.SetProjection(r_ds.GetProjection())
+    if ndv is not None:
+        for n in range(nbands):
+            out_ds.GetRasterBand(n+1).SetNoDataValue(ndv)
+    return out_ds
+
+#Rasterize polygons once to an integer label raster on the grid of r_ds (0 outside, n for the nth feature)
+#Returns the label dataset and a list of feature names, where names[n-1] corresponds to label n
+#Written to a GeoTIFF if out_fn is given, so it can be read block by block alongside the DEMs
+def shp2labels_ds(shp_fn, r_ds, out_fn=None, name_field='RGIId'):
+    if out_fn is None:
+        labels_ds = gdal.GetDriverByName('MEM').Create('', r_ds.RasterXSize, r_ds.RasterYSize, 1, gdal.GDT_UInt32)
+        labels_ds.SetGeoTransform(r_ds.GetGeoTransform())
+        labels_ds.SetProjection(r_ds.GetProjection())
     else:
-        ax.pcolormesh(xedges,yedges,Hmasked,cmap='inferno',vmin=H_clim[0],vmax=H_clim[1])
-    ax.plot(xedges[:-1]+np.diff(xedges), ymax, color='dodgerblue',lw=1.0)
-
-#Now, let's make some quick plots of elevation change vs. elevation for the two time periods
-f, axa = plt.subplots(2, sharex=True, sharey=True)
-dem_clim = (1000,4400)
-dhdt_clim = (-3, 3)
-plot_2dhist(axa[0], dem_list[0], dhdt_list_shpclip[0], dem_clim, dhdt_clim)
-axa[0].set_title('1970 to 2008')
-axa[0].set_ylabel('Elev. Change Rate (m/yr)')
-axa[0].axhline(0,lw=0.5,ls='-',c='r',alpha=0.5)
-plot_2dhist(axa[1], dem_list[1], dhdt_list_shpclip[1], dem_clim, dhdt_clim)
-axa[1].set_title('2008 to 2015')
-axa[1].set_ylabel('Elev. Change Rate (m/yr)')
-axa[1].axhline(0,lw=0.5,ls='-',c='r',alpha=0.5)
-axa[1].set_xlabel('Elevation (m WGS84)')
-f.tight_layout()
-f.savefig('dem_vs_dhdt_log.png', bbox_inches='tight', pad_inches=0, dpi=150)
-plt.show()
+        labels_ds = create_like(r_ds, out_fn, dtype=gdal.GDT_UInt32, ndv=None)
+    shp_ds = ogr.Open(shp_fn)
+    lyr = shp_ds.GetLayer()
+    #Copy features to an in-memory layer with a sequential integer label field, so one RasterizeLayer call burns all polygons
+    tmp_ds = ogr.GetDriverByName('Memory').CreateDataSource('')
+    tmp_lyr = tmp_ds.CreateLayer('labels', lyr.GetSpatialRef(), ogr.wkbMultiPolygon)
+    tmp_lyr.CreateField(ogr.FieldDefn('label', ogr.OFTInteger))
+    has_name = lyr.GetLayerDefn().GetFieldIndex(name_field) >= 0
+    names = []
+    for n, feat in enumerate(lyr):
+        names.append(feat.GetField(name_field) if has_name else str(feat.GetFID()))
+        tmp_feat = ogr.Feature(tmp_lyr.GetLayerDefn())
+        tmp_feat.SetGeometry(feat.GetGeometryRef())
+        tmp_feat.SetField('label', n + 1)
+        tmp_lyr.CreateFeature(tmp_feat)
+    #Features are reprojected on the fly if the layer SRS differs from the raster SRS
+    gdal.RasterizeLayer(labels_ds, [1], tmp_lyr, options=['ATTRIBUTE=label'])
+    labels_ds.FlushCache()
+    return labels_ds, names
+
+#Write a tidy per-glacier table (one row per glacier and period) of dh/dt, area, volume and mass change rates
+#stats_list holds one labeled StreamStats per period; label 0 (outside all polygons) is skipped
+def write_zonal_csv(out_fn, names, titles, stats_list, px_area, dt_list, rho=0.850):
+    import csv
+    with open(out_fn, 'w') as f:
+        w = csv.writer(f)
+        w.writerow(['glacier', 'period', 'dt_yr', 'count', 'area_km2', 'dhdt_mean', 'dhdt_std', 'dhdt_min', 'dhdt_max', 'vol_rate_km3yr', 'mass_rate_gtyr'])
+        for title, dt, stats in zip(titles, dt_list, stats_list):
+            area = px_area * stats.count / 1E6
+            vol_rate, vol_total, mass_rate, mass_total = calc_volmass(stats.mean, area, dt, rho)
+            std = stats.std()
+            for n, name in enumerate(names, 1):
+                if stats.count[n] == 0:
+                    continue
+                w.writerow([name, title, '%0.2f' % dt, stats.count[n], '%0.4f' % area[n], \
+                        '%0.3f' % stats.mean[n], '%0.3f' % std[n], '%0.3f' % stats.min[n], '%0.3f' % stats.max[n], \
+                        '%0.6f' % vol_rate[n], '%0.6f' % mass_rate[n]])
+
+#Lazy alternative to warplib.memwarp_multi_fn
+#Each input is wrapped as a warped VRT on the shared grid, so pixels are only resampled when a window is actually read
+#ds_list holds ordinary GDAL datasets, so existing consumers (iolib.ds_getma, gdal.DEMProcessing, stream_dh) work unchanged
+#With outdir, the VRTs are written to disk so that worker processes can open them by filename
+class WarpedStack(object):
+    def __init__(self, src_fn_list, res='first', extent='intersection', t_srs='first', r='cubic', outdir=None):
+        self.src_fn_list = src_fn_list
+        src_ds_list = [gdal.Open(fn) for fn in src_fn_list]
+        #Resolve the shared grid with the same rules as memwarp_multi_fn
+        self.t_srs = warplib.parse_srs(t_srs, src_ds_list)
+        self.res = warplib.parse_res(res, src_ds_list, self.t_srs)
+        self.extent = warplib.parse_extent(extent, src_ds_list, self.t_srs)
+        self.ds_list = []
+        for fn, src_ds in zip(src_fn_list, src_ds_list):
+            vrt_fn = ''
+            if outdir is not None:
+                vrt_fn = os.path.join(outdir, os.path.splitext(os.path.basename(fn))[0] + '_warp.vrt')
+            ndv = iolib.get_ndv_ds(src_ds)
+            ds = gdal.Warp(vrt_fn, src_ds, format='VRT', outputBounds=self.extent, xRes=self.res, yRes=self.res, \
+                    dstSRS=self.t_srs.ExportToWkt(), resampleAlg=r, srcNodata=ndv, dstNodata=ndv)
+            self.ds_list.append(ds)
+
+    def __len__(self):
+        return len(self.ds_list)
+
+    def __getitem__(self, n):
+        return self.ds_list[n]
+
+#SHA-1 of file contents, memoized on (path, size, mtime) in a small JSON index so large inputs are only hashed once
+def file_hash(fn, index=None):
+    import hashlib
+    st = os.stat(fn)
+    path = os.path.abspath(fn)
+    idx_key = '%s:%i:%i' % (path, st.st_size, int(st.st_mtime))
+    if index is not None:
+        if idx_key in index:
+            return index[idx_key]
+        #File was modified, so hashes of its earlier versions will never be used again
+        for k in [k for k in index if k.rsplit(':', 2)[0] == path]:
+            del index[k]
+    h = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            h.update(chunk)
+    if index is not None:
+        index[idx_key] = h.hexdigest()
+    return h.hexdigest()
+
+#Total size of files in a directory (bytes)
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, fn)) for root, dirs, fns in os.walk(path) for fn in fns)
+
+#Drop least recently used cache entries until the cache is no larger than max_bytes
+#Temporary entries older than max_tmp_age (seconds) were left by crashed runs and are removed too
+def evict_lru(cachedir, max_bytes, keep=None, max_tmp_age=24*3600):
+    import shutil
+    import time
+    dirs = [d for d in os.listdir(cachedir) if os.path.isdir(os.path.join(cachedir, d))]
+    #Skip in-progress entries from concurrent runs
+    for d in dirs:
+        tmp = os.path.join(cachedir, d)
+        if d.startswith('.tmp_') and time.time() - os.path.getmtime(tmp) > max_tmp_age:
+            shutil.rmtree(tmp, ignore_errors=True)
+    entries = [os.path.join(cachedir, d) for d in dirs if not d.startswith('.tmp_')]
+    entries.sort(key=os.path.getmtime)
+    sizes = dict((e, dir_size(e)) for e in entries)
+    total = sum(sizes.values())
+    for e in entries:
+        if total <= max_bytes:
+            break
+        if e == keep:
+            continue
+        shutil.rmtree(e, ignore_errors=True)
+        total -= sizes[e]
+
+#Drop-in replacement for warplib.diskwarp_multi_fn that reuses previous warps from cachedir
+#Entries are keyed on input file contents, target SRS, resolution, extent and resampling method,
+#and hold tiled, compressed GeoTIFFs. Hits refresh the entry, and the cache is kept under max_bytes (LRU)
+def cached_warp_multi_fn(src_fn_list, cachedir, res='first', extent='intersection', t_srs='first', r='cubic', max_bytes=20*2**30):
+    import json
+    import hashlib
+    import shutil
+    import tempfile
+    if not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    index_fn = os.path.join(cachedir, 'hash_index.json')
+    index = {}
+    if os.path.exists(index_fn):
+        with open(index_fn) as f:
+            index = json.load(f)
+    #Drop hashes of files that no longer exist
+    for k in [k for k in index if not os.path.exists(k.rsplit(':', 2)[0])]:
+        del index[k]
+    #Parameters that are filenames (e.g., t_srs=dem_2015_fn) are keyed on file contents too
+    def param_key(p):
+        if isinstance(p, str) and os.path.isfile(p):
+            return file_hash(p, index)
+        return str(p)
+    key_list = [file_hash(fn, index) for fn in src_fn_list] + [param_key(p) for p in (res, extent, t_srs, r)]
+    #Write through a temporary file, so concurrent runs never read a partial index
+    tmp_fn = '%s.%i.tmp' % (index_fn, os.getpid())
+    with open(tmp_fn, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_fn, index_fn)
+    key = hashlib.sha1('|'.join(key_list).encode('utf-8')).hexdigest()
+    entry = os.path.join(cachedir, key)
+    manifest_fn = os.path.join(entry, 'manifest.json')
+    if os.path.exists(manifest_fn):
+        print('Warp cache hit: %s' % entry)
+        os.utime(entry, None)
+    else:
+        print('Warp cache miss: %s' % entry)
+        tmpdir = tempfile.mkdtemp(dir=cachedir, prefix='.tmp_')
+        try:
+            ds_list = warplib.diskwarp_multi_fn(src_fn_list, res=res, extent=extent, t_srs=t_srs, r=r, outdir=tmpdir)
+            out_list = []
+            for n, ds in enumerate(ds_list):
+                out_fn = os.path.join(tmpdir, '%02i_%s' % (n, os.path.basename(src_fn_list[n])))
+                #Inputs that already matched the output grid may come back unwarped, so always write a local copy
+                gdal.Translate(out_fn, ds, creationOptions=iolib.gdal_opt)
+                out_list.append(os.path.basename(out_fn))
+            ds_list = None
+            for fn in os.listdir(tmpdir):
+                if fn not in out_list:
+                    os.remove(os.path.join(tmpdir, fn))
+            with open(os.path.join(tmpdir, 'manifest.json'), 'w') as f:
+                json.dump({'inputs':src_fn_list, 'outputs':out_list, 'key':key_list}, f)
+            #Atomic publish, so a crashed run never leaves a partial entry behind
+            try:
+                os.rename(tmpdir, entry)
+            except OSError:
+                #A concurrent run with the same key published first, so use its entry
+                if not os.path.exists(manifest_fn):
+                    raise
+                print('Warp cache: using entry published by a concurrent run')
+        finally:
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        evict_lru(cachedir, max_bytes, keep=entry)
+    with open(manifest_fn) as f:
+        manifest = json.load(f)
+    return [gdal.Open(os.path.join(entry, fn)) for fn in manifest['outputs']]
+
+#Persistent SQLite catalog of DEM rasters: acquisition time, footprint, SRS, resolution and NoData
+#Headers are read once, and update() only re-reads files whose size or mtime changed, so huge archives stay cheap to rescan
+#Footprints are stored in lon/lat in an R*Tree, so bbox and time range queries don't touch the rasters at all
+class DemCatalog(object):
+    def __init__(self, db_fn):
+        import sqlite3
+        self.con = sqlite3.connect(db_fn)
+        with self.con:
+            self.con.execute('CREATE TABLE IF NOT EXISTS raster (id INTEGER PRIMARY KEY, fn TEXT UNIQUE, size INTEGER, mtime REAL, \
+                    dt TEXT, decyear REAL, srs TEXT, xres REAL, yres REAL, nx INTEGER, ny INTEGER, ndv REAL, \
+                    xmin REAL, ymin REAL, xmax REAL, ymax REAL)')
+            self.con.execute('CREATE INDEX IF NOT EXISTS raster_decyear ON raster (decyear)')
+            try:
+                self.con.execute('CREATE VIRTUAL TABLE IF NOT EXISTS footprint USING rtree (id, xmin, xmax, ymin, ymax)')
+            except sqlite3.OperationalError:
+                #SQLite built without R*Tree support, same columns as a plain table
+                self.con.execute('CREATE TABLE IF NOT EXISTS footprint (id INTEGER PRIMARY KEY, xmin REAL, xmax REAL, ymin REAL, ymax REAL)')
+
+    #Header fields for one raster, or None if GDAL can't open it
+    @staticmethod
+    def read_header(fn):
+        ds = gdal.Open(fn)
+        if ds is None:
+            return None
+        st = os.stat(fn)
+        dt = timelib.fn_getdatetime(fn)
+        res = geolib.get_res(ds)
+        h = {'fn':fn, 'size':st.st_size, 'mtime':st.st_mtime, 'srs':ds.GetProjection(), \
+                'xres':res[0], 'yres':res[1], 'nx':ds.RasterXSize, 'ny':ds.RasterYSize, 'ndv':iolib.get_ndv_ds(ds), \
+                'dt':dt.isoformat() if dt is not None else None, 'decyear':timelib.dt2decyear(dt) if dt is not None else None}
+        h['xmin'], h['ymin'], h['xmax'], h['ymax'] = geolib.ds_extent(ds)
+        h['footprint'] = geolib.ds_extent(ds, geolib.wgs_srs)
+        return h
+
+    #Index new and changed rasters matching pattern under the root directories, and drop entries for deleted files
+    #Headers are read in a thread pool, since most of the time is spent waiting on file I/O
+    #Returns the number of rasters (re)indexed and removed
+    def update(self, root_list, pattern='*.tif', nthreads=8):
+        import fnmatch
+        from multiprocessing.pool import ThreadPool
+        root_list = [os.path.abspath(root) for root in root_list]
+        indexed = dict((fn, (size, mtime)) for fn, size, mtime in self.con.execute('SELECT fn, size, mtime FROM raster'))
+        seen = set()
+        changed = []
+        for root in root_list:
+            for dirpath, dirs, fns in os.walk(root):
+                for fn in fnmatch.filter(fns, pattern):
+                    fn = os.path.join(dirpath, fn)
+                    seen.add(fn)
+                    st = os.stat(fn)
+                    if indexed.get(fn) != (st.st_size, st.st_mtime):
+                        changed.append(fn)
+        removed = [fn for fn in indexed if fn not in seen and any(fn.startswith(root + os.sep) for root in root_list)]
+        pool = ThreadPool(nthreads)
+        header_list = [h for h in pool.imap_unordered(DemCatalog.read_header, changed, chunksize=16) if h is not None]
+        pool.close()
+        pool.join()
+        cols = ['fn', 'size', 'mtime', 'dt', 'decyear', 'srs', 'xres', 'yres', 'nx', 'ny', 'ndv', 'xmin', 'ymin', 'xmax', 'ymax']
+        with self.con:
+            #Changed files GDAL can no longer open are dropped too, rather than keeping their stale entries
+            for fn in removed + changed:
+                self.con.execute('DELETE FROM footprint WHERE id IN (SELECT id FROM raster WHERE fn = ?)', (fn,))
+                self.con.execute('DELETE FROM raster WHERE fn = ?', (fn,))
+            for h in header_list:
+                cur = self.con.execute('INSERT INTO raster (%s) VALUES (%s)' % (', '.join(cols), ', '.join('?'*len(cols))), [h[c] for c in cols])
+                xmin, ymin, xmax, ymax = h['footprint']
+                self.con.execute('INSERT INTO footprint VALUES (?, ?, ?, ?, ?)', (cur.lastrowid, xmin, xmax, ymin, ymax))
+        return len(header_list), len(removed)
+
+    #Time-ordered filenames of rasters with a parsed timestamp, optionally intersecting bbox [lonmin, latmin, lonmax, latmax]
+    #and acquired between t0 and t1 (datetime or decimal year, inclusive)
+    def query(self, bbox=None, t0=None, t1=None):
+        sql = 'SELECT r.fn FROM raster r'
+        where = ['r.decyear IS NOT NULL']
+        params = []
+        if bbox is not None:
+            sql += ' JOIN footprint f ON f.id = r.id'
+            where += ['f.xmax >= ?', 'f.xmin <= ?', 'f.ymax >= ?', 'f.ymin <= ?']
+            params += [bbox[0], bbox[2], bbox[1], bbox[3]]
+        for t, op in ((t0, '>='), (t1, '<=')):
+            if t is not None:
+                where.append('r.decyear %s ?' % op)
+                params.append(timelib.dt2decyear(t) if hasattr(t, 'year') else float(t))
+        sql += ' WHERE ' + ' AND '.join(where) + ' ORDER BY r.decyear'
+        return [row[0] for row in self.con.execute(sql, params)]
+
+    #Acquisition times for indexed filenames, as parsed when they were indexed
+    def datetimes(self, fn_list):
+        from datetime import datetime
+        dt = {}
+        #Stay under the SQLite limit on query parameters
+        for n in range(0, len(fn_list), 500):
+            chunk = fn_list[n:n+500]
+            dt.update(self.con.execute('SELECT fn, dt FROM raster WHERE fn IN (%s)' % ', '.join('?'*len(chunk)), chunk))
+        fmt = lambda s: '%Y-%m-%dT%H:%M:%S.%f' if '.' in s else ('%Y-%m-%dT%H:%M:%S' if 'T' in s else '%Y-%m-%d')
+        return [datetime.strptime(dt[fn], fmt(dt[fn])) for fn in fn_list]
+
+#Bounding box [xmin, ymin, xmax, ymax] in t_srs of an extent in s_srs
+#Edges are densified before transforming, so the box still covers edges that become curved
+def transform_extent(extent, s_srs, t_srs, n=16):
+    if s_srs.IsSame(t_srs):
+        return list(extent)
+    xmin, ymin, xmax, ymax = extent
+    geom = ogr.CreateGeometryFromWkt('POLYGON ((%f %f, %f %f, %f %f, %f %f, %f %f))' % \
+            (xmin, ymin, xmax, ymin, xmax, ymax, xmin, ymax, xmin, ymin))
+    geom.Segmentize(max(xmax - xmin, ymax - ymin) / float(n))
+    geom.AssignSpatialReference(s_srs)
+    geom.TransformTo(t_srs)
+    xmin, xmax, ymin, ymax = geom.GetEnvelope()
+    return [xmin, ymin, xmax, ymax]
+
+#Bounding box of all features in a polygon shapefile, in t_srs ([lonmin, latmin, lonmax, latmax] by default)
+def shp_extent(shp_fn, t_srs=None):
+    lyr = ogr.Open(shp_fn).GetLayer()
+    xmin, xmax, ymin, ymax = lyr.GetExtent()
+    return transform_extent([xmin, ymin, xmax, ymax], lyr.GetSpatialRef(), t_srs if t_srs is not None else geolib.wgs_srs)
+
+#STRtree (R-tree) over raster footprints in a common SRS, built from headers or catalog entries without reading pixels
+#select() prunes inputs to those overlapping a bbox and precomputes the grid that warplib would otherwise derive
+#by opening every input, so memwarp_multi_fn/diskwarp_multi_fn only ever touch the overlapping rasters
+class FootprintIndex(object):
+    def __init__(self, fn_list, extent_list, res_list):
+        from shapely.geometry import box
+        from shapely.strtree import STRtree
+        self.fn_list = list(fn_list)
+        self.extent = np.array(extent_list, dtype=np.float64)
+        self.res = np.array(res_list, dtype=np.float64)
+        self.geoms = [box(*e) for e in self.extent]
+        self._geom_idx = dict((id(g), n) for n, g in enumerate(self.geoms))
+        self.tree = STRtree(self.geoms)
+
+    #Footprint and resolution in t_srs from a native extent and raster size
+    #Resolution is the finer of the two axes after reprojection, matching res='min' for inputs that are already in t_srs
+    @staticmethod
+    def _reproject(extent, nx, ny, s_srs, t_srs):
+        e = transform_extent(extent, s_srs, t_srs)
+        return e, min((e[2] - e[0]) / float(nx), (e[3] - e[1]) / float(ny))
+
+    #Index rasters by reading only their headers
+    @classmethod
+    def from_headers(cls, fn_list, t_srs):
+        extent_list, res_list = [], []
+        for fn in fn_list:
+            ds = gdal.Open(fn)
+            e, res = cls._reproject(geolib.ds_extent(ds), ds.RasterXSize, ds.RasterYSize, geolib.get_ds_srs(ds), t_srs)
+            extent_list.append(e)
+            res_list.append(res)
+        return cls(fn_list, extent_list, res_list)
+
+    #Index cataloged rasters without opening any files
+    @classmethod
+    def from_catalog(cls, catalog, fn_list, t_srs):
+        rows = dict((r[0], r[1:]) for r in catalog.con.execute('SELECT fn, srs, xmin, ymin, xmax, ymax, nx, ny FROM raster'))
+        extent_list, res_list = [], []
+        srs_cache = {}
+        for fn in fn_list:
+            wkt, xmin, ymin, xmax, ymax, nx, ny = rows[fn]
+            if wkt not in srs_cache:
+                srs_cache[wkt] = osr.SpatialReference(wkt)
+            e, res = cls._reproject([xmin, ymin, xmax, ymax], nx, ny, srs_cache[wkt], t_srs)
+            extent_list.append(e)
+            res_list.append(res)
+        return cls(fn_list, extent_list, res_list)
+
+    #Indices (in input order) of footprints intersecting bbox [xmin, ymin, xmax, ymax]
+    def query(self, bbox):
+        from shapely.geometry import box
+        q = box(*bbox)
+        hits = self.tree.query(q)
+        #Shapely 2 returns indices, Shapely 1.x returns the geometries themselves
+        if len(hits) and hasattr(hits[0], 'geom_type'):
+            idx = [self._geom_idx[id(g)] for g in hits]
+        else:
+            idx = [int(n) for n in hits]
+        return sorted(n for n in idx if self.geoms[n].intersects(q))
+
+    #Candidate filenames overlapping bbox (all inputs if None), with their intersection extent (None if they don't all overlap),
+    #union extent and finest resolution, ready to pass as extent= and res= to the warplib functions
+    def select(self, bbox=None):
+        idx = self.query(bbox) if bbox is not None else list(range(len(self.fn_list)))
+        if not idx:
+            return [], None, None, None
+        e = self.extent[idx]
+        isect = np.r_[e[:,:2].max(axis=0), e[:,2:].min(axis=0)].tolist()
+        if isect[0] >= isect[2] or isect[1] >= isect[3]:
+            isect = None
+        union = np.r_[e[:,:2].min(axis=0), e[:,2:].max(axis=0)].tolist()
+        return [self.fn_list[n] for n in idx], isect, union, float(self.res[idx].min())
+
+#Horn (1981) x (east) and y (south) elevation gradients of a (masked) DEM array, as used by gdaldem
+#Edges are padded by repeating values, so pass a tile with a 1-px halo for seamless tiled output
+def horn_gradient(dem, xres, yres):
+    z = np.pad(np.ma.filled(dem.astype(np.float32), np.nan), 1, mode='edge')
+    a, b, c = z[:-2,:-2], z[:-2,1:-1], z[:-2,2:]
+    d, f = z[1:-1,:-2], z[1:-1,2:]
+    g, h, i = z[2:,:-2], z[2:,1:-1], z[2:,2:]
+    dzdx = ((c + 2*f + i) - (a + 2*d + g)) / (8.0 * xres)
+    dzdy = ((g + 2*h + i) - (a + 2*b + c)) / (8.0 * yres)
+    return dzdx, dzdy
+
+#Shaded relief from a (masked) DEM array, matching gdaldem hillshade
+#Output is Byte-scaled 1-255, with 0 for NoData
+def hillshade(dem, xres, yres, az=315.0, alt=45.0, z_factor=1.0):
+    dzdx, dzdy = horn_gradient(dem, xres, yres)
+    slope = np.arctan(z_factor * np.sqrt(dzdx**2 + dzdy**2))
+    aspect = np.arctan2(dzdy, -dzdx)
+    zenith = np.radians(90.0 - alt)
+    az_math = np.radians(360.0 - az + 90.0)
+    cang = np.cos(zenith)*np.cos(slope) + np.sin(zenith)*np.sin(slope)*np.cos(az_math - aspect)
+    hs = 1 + 254*np.clip(cang, 0, 1)
+    #Round to nearest like gdaldem, rather than truncating in the cast
+    return np.rint(np.where(np.isnan(hs), 0, hs)).astype(np.uint8)
+
+#Slope in degrees, NaN for NoData
+def slope(dem, xres, yres, z_factor=1.0):
+    dzdx, dzdy = horn_gradient(dem, xres, yres)
+    return np.degrees(np.arctan(z_factor * np.sqrt(dzdx**2 + dzdy**2))).astype(np.float32)
+
+#Aspect in degrees clockwise from north (direction the slope faces), NaN for NoData
+def aspect(dem, xres, yres):
+    dzdx, dzdy = horn_gradient(dem, xres, yres)
+    return np.mod(np.degrees(np.arctan2(-dzdx, dzdy)), 360).astype(np.float32)
+
+#Kernel, output type and NoData value for each DEM derivative product
+dem_products = {'hillshade':(hillshade, gdal.GDT_Byte, 0), \
+        'slope':(slope, gdal.GDT_Float32, -9999), \
+        'aspect':(aspect, gdal.GDT_Float32, -9999)}
+
+#Hillshade, slope or aspect of a DEM dataset, computed on 1-px halo tiles across a thread pool
+#NumPy releases the GIL for the kernel math, so tiles compute in parallel, while GDAL reads and writes are serialized with a lock
+#Writes straight to a tiled, compressed GeoTIFF if out_fn is given, otherwise to an in-memory dataset
+def dem_derivative_ds(dem_ds, product='hillshade', out_fn=None, tile=1024, nthreads=None, **kwargs):
+    import threading
+    from multiprocessing.pool import ThreadPool
+    func, dtype, ndv = dem_products[product]
+    if out_fn is None:
+        out_ds = gdal.GetDriverByName('MEM').Create('', dem_ds.RasterXSize, dem_ds.RasterYSize, 1, dtype)
+        out_ds.SetGeoTransform(dem_ds.GetGeoTransform())
+        out_ds.SetProjection(dem_ds.GetProjection())
+        out_ds.GetRasterBand(1).SetNoDataValue(ndv)
+    else:
+        out_ds = create_like(dem_ds, out_fn, dtype=dtype, ndv=ndv)
+    gt = dem_ds.GetGeoTransform()
+    lock = threading.Lock()
+    def run_tile(win):
+        xoff, yoff, xsize, ysize = win
+        px0 = max(xoff - 1, 0)
+        py0 = max(yoff - 1, 0)
+        px1 = min(xoff + xsize + 1, dem_ds.RasterXSize)
+        py1 = min(yoff + ysize + 1, dem_ds.RasterYSize)
+        with lock:
+            dem = ds_getma_win(dem_ds, (px0, py0, px1 - px0, py1 - py0))
+        out = func(dem, gt[1], -gt[5], **kwargs)[yoff-py0:yoff-py0+ysize, xoff-px0:xoff-px0+xsize]
+        if out.dtype.kind == 'f':
+            out = np.where(np.isnan(out), ndv, out)
+        with lock:
+            out_ds.GetRasterBand(1).WriteArray(out, xoff, yoff)
+    pool = ThreadPool(nthreads)
+    pool.map(run_tile, list(block_windows(dem_ds, bs=(tile, tile))))
+    pool.close()
+    pool.join()
+    out_ds.FlushCache()
+    return out_ds
+
+#Per-process state for _process_tile, so datasets are opened once per worker rather than once per tile
+_tile_ctx = {}
+
+def _init_tile_worker(dem_fn_list, labels_fn, nlabels, pair_list, dt_list, halo, ndv, skip_empty=False, xlim=(1000, 4400), ylim=(-3, 3), \
+        tile_dir=None):
+    _tile_ctx['skip_empty'] = skip_empty
+    _tile_ctx['tile_dir'] = tile_dir
+    _tile_ctx['ds_list'] = [gdal.Open(fn) for fn in dem_fn_list]
+    _tile_ctx['labels_ds'] = gdal.Open(labels_fn) if labels_fn is not None else None
+    _tile_ctx['nlabels'] = nlabels
+    _tile_ctx['pair_list'] = pair_list
+    _tile_ctx['dt_list'] = dt_list
+    _tile_ctx['halo'] = halo
+    _tile_ctx['ndv'] = ndv
+    _tile_ctx['xlim'] = xlim
+    _tile_ctx['ylim'] = ylim
+
+#Name, band count, data type and NoData value of each stream_dh output
+def stream_dh_outputs(pair_list, ndv):
+    return (('dh', len(pair_list), gdal.GDT_Float32, ndv), \
+            ('dhdt', len(pair_list), gdal.GDT_Float32, ndv), \
+            ('hs', len(hs_index(pair_list)), gdal.GDT_Byte, 0), \
+            ('dhdt_shpclip', len(pair_list), gdal.GDT_Float32, ndv))
+
+#Write one tile of an output (bands x rows x cols) to its own GeoTIFF, georeferenced at win on the grid of r_ds
+def write_tile(out_fn, a, r_ds, win, dtype, ndv):
+    gt = r_ds.GetGeoTransform()
+    ds = iolib.gtif_drv.Create(out_fn, win[2], win[3], a.shape[0], dtype, options=iolib.gdal_opt)
+    ds.SetGeoTransform((gt[0] + win[0]*gt[1], gt[1], gt[2], gt[3] + win[1]*gt[5], gt[4], gt[5]))
+    ds.SetProjection(r_ds.GetProjection())
+    for n in range(a.shape[0]):
+        b = ds.GetRasterBand(n+1)
+        b.SetNoDataValue(ndv)
+        b.WriteArray(a[n])
+    ds = None
+
+#Compute dh, dh/dt, hillshade and glacier-clipped dh/dt for one tile of the common grid
+#The tile is read with a halo so that neighborhood operations (hillshade) are seamless across tiles
+#Only DEMs at the start of a period are hillshaded, as those are the only ones used for overlays
+#With skip_empty, tiles without labeled (glacier) pixels are never read, which avoids warping them when inputs are lazy VRTs
+#With a tile_dir, the outputs are written there by the worker and only the statistics are returned,
+#otherwise a dict of output arrays is returned for the caller to write
+def _process_tile(win):
+    ds_list = _tile_ctx['ds_list']
+    labels_ds = _tile_ctx['labels_ds']
+    nlabels = _tile_ctx['nlabels']
+    pair_list = _tile_ctx['pair_list']
+    dt_list = _tile_ctx['dt_list']
+    halo = _tile_ctx['halo']
+    ndv = _tile_ctx['ndv']
+    r_ds = ds_list[0]
+    gt = r_ds.GetGeoTransform()
+    xoff, yoff, xsize, ysize = win
+    #Pad window with halo, clipped to the grid
+    px0 = max(xoff - halo, 0)
+    py0 = max(yoff - halo, 0)
+    px1 = min(xoff + xsize + halo, r_ds.RasterXSize)
+    py1 = min(yoff + ysize + halo, r_ds.RasterYSize)
+    pwin = (px0, py0, px1 - px0, py1 - py0)
+    #Slices to trim the halo back off
+    crop = (slice(yoff - py0, yoff - py0 + ysize), slice(xoff - px0, xoff - px0 + xsize))
+    if labels_ds is not None:
+        labels = labels_ds.GetRasterBand(1).ReadAsArray(*win)
+    else:
+        labels = np.ones((ysize, xsize), dtype=np.uint32)
+    outside = (labels == 0)
+    if _tile_ctx['skip_empty'] and outside.all():
+        return None
+    dem_list = [ds_getma_win(ds, pwin) for ds in ds_list]
+    hs = np.array([hillshade(dem_list[i], gt[1], -gt[5])[crop] for i in hs_index(pair_list)])
+    dem_list = [dem[crop] for dem in dem_list]
+    dh = np.ma.array([dem_list[j] - dem_list[i] for i, j in pair_list])
+    dhdt = dh / np.array(dt_list)[:,np.newaxis,np.newaxis]
+    dhdt_clip = np.ma.array(dhdt, mask=(np.ma.getmaskarray(dhdt) | outside))
+    stats_list = [StreamStats(nlabels).update(a, labels) for a in dhdt_clip]
+    #Elevation at the start of each period vs. glacier dh/dt
+    hist_list = [Hist2D(_tile_ctx['xlim'], _tile_ctx['ylim']).update(dem_list[i], dhdt_clip[n]) for n, (i, j) in enumerate(pair_list)]
+    out = {'dh':dh.filled(ndv), 'dhdt':dhdt.filled(ndv), 'hs':hs, 'dhdt_shpclip':dhdt_clip.filled(ndv)}
+    tile_dir = _tile_ctx['tile_dir']
+    if tile_dir is not None:
+        for key, nbands, dtype, key_ndv in stream_dh_outputs(pair_list, ndv):
+            write_tile(os.path.join(tile_dir, key, '%i_%i.tif' % (yoff, xoff)), out[key], r_ds, win, dtype, key_ndv)
+        out = None
+    return win, out, stats_list, hist_list
+
+#Indices of the DEMs at the start of each period, in the band order of the streamed hillshade output
+def hs_index(pair_list):
+    return sorted(set(i for i, j in pair_list))
+
+#Walk the common grid tile by tile, computing dh and dh/dt for each (i, j) index pair in pair_list
+#dh, dh/dt and glacier-clipped dh/dt (one band per pair) and hillshade (one band per hs_index DEM) are written to tiled GeoTIFFs in outdir
+#Returns output filenames, plus a StreamStats of dh/dt grouped by label and a Hist2D of glacier dh/dt vs. elevation for each pair
+#Peak memory is set by the tile size, not the scene size
+#With nproc > 1, tiles are processed in a pool of worker processes, which write (and compress) their own tiles,
+#and only statistics go back to the parent, which mosaics the tiles through a VRT into each output
+#With skip_empty, tiles outside all labels are left as NoData in the outputs
+#xlim and ylim are the elevation and dh/dt limits of the 2D histograms
+def stream_dh(ds_list, pair_list, dt_list, labels_ds=None, nlabels=2, outdir='.', ndv=-9999, nproc=1, tile=None, halo=1, skip_empty=False, \
+        xlim=(1000, 4400), ylim=(-3, 3)):
+    r_ds = ds_list[0]
+    #Workers open their own handles, so make sure everything is on disk first
+    for ds in ds_list:
+        ds.FlushCache()
+    dem_fn_list = [ds.GetDescription() for ds in ds_list]
+    labels_fn = labels_ds.GetDescription() if labels_ds is not None else None
+    outputs = stream_dh_outputs(pair_list, ndv)
+    out_fn = dict((key, os.path.join(outdir, 'dem_%s.tif' % key)) for key, nbands, dtype, key_ndv in outputs)
+    out_ds = {}
+    tile_dir = None
+    if nproc > 1:
+        import tempfile
+        tile_dir = tempfile.mkdtemp(dir=outdir, prefix='.tiles_')
+        for key in out_fn:
+            os.makedirs(os.path.join(tile_dir, key))
+    else:
+        for key, nbands, dtype, key_ndv in outputs:
+            out_ds[key] = create_like(r_ds, out_fn[key], nbands, dtype=dtype, ndv=key_ndv)
+    #Default to the natural block size for serial runs, and larger tiles to amortize per-tile overhead for parallel runs
+    if tile is None and nproc > 1:
+        tile = 1024
+    bs = (tile, tile) if tile is not None else None
+    win_list = list(block_windows(r_ds, bs=bs))
+    initargs = (dem_fn_list, labels_fn, nlabels, pair_list, dt_list, halo, ndv, skip_empty, xlim, ylim, tile_dir)
+    if nproc > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(nproc, initializer=_init_tile_worker, initargs=initargs)
+        results = pool.imap_unordered(_process_tile, win_list)
+    else:
+        pool = None
+        _init_tile_worker(*initargs)
+        results = (_process_tile(win) for win in win_list)
+    stats_list = [StreamStats(nlabels) for pair in pair_list]
+    hist_list = [Hist2D(xlim, ylim) for pair in pair_list]
+    try:
+        for result in results:
+            if result is None:
+                continue
+            win, out, tile_stats_list, tile_hist_list = result
+            if out is not None:
+                for key, a in out.items():
+                    for n in range(a.shape[0]):
+                        out_ds[key].GetRasterBand(n+1).WriteArray(a[n], win[0], win[1])
+            for stats, tile_stats in zip(stats_list, tile_stats_list):
+                stats.merge(tile_stats)
+            for hist, tile_hist in zip(hist_list, tile_hist_list):
+                hist.merge(tile_hist)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if tile_dir is not None:
+            mosaic_tiles(tile_dir, r_ds, outputs, out_fn)
+    finally:
+        if tile_dir is not None:
+            import shutil
+            shutil.rmtree(tile_dir, ignore_errors=True)
+    out_ds = None
+    return out_fn, stats_list, hist_list
+
+#Mosaic the per-tile GeoTIFFs written by stream_dh workers into each full-grid output
+#Tiles are assembled with a VRT on the grid of r_ds, so skipped tiles come out as NoData
+def mosaic_tiles(tile_dir, r_ds, outputs, out_fn):
+    import glob
+    gt = r_ds.GetGeoTransform()
+    bounds = (gt[0], gt[3] + r_ds.RasterYSize*gt[5], gt[0] + r_ds.RasterXSize*gt[1], gt[3])
+    opt = iolib.gdal_opt + ['NUM_THREADS=ALL_CPUS']
+    for key, nbands, dtype, key_ndv in outputs:
+        tile_fn_list = sorted(glob.glob(os.path.join(tile_dir, key, '*.tif')))
+        if not tile_fn_list:
+            #Every tile was skipped
+            create_like(r_ds, out_fn[key], nbands, dtype=dtype, ndv=key_ndv).FlushCache()
+            continue
+        vrt = gdal.BuildVRT(os.path.join(tile_dir, '%s.vrt' % key), tile_fn_list, outputBounds=bounds, \
+                resolution='user', xRes=gt[1], yRes=abs(gt[5]), VRTNodata=key_ndv)
+        gdal.Translate(out_fn[key], vrt, creationOptions=opt)
+        vrt = None
+
+#Stack co-registered DEM datasets into a single time x y x x cube on disk, one band per epoch
+#Pixel interleaving keeps the whole time series of a tile in one block, so trend chunks read contiguously
+#Decimal year of each band is stored in band metadata (DECYEAR)
+def build_dem_cube(ds_list, t_decyear, out_fn, ndv=-9999):
+    r_ds = ds_list[0]
+    opt = iolib.gdal_opt + ['INTERLEAVE=PIXEL', 'NUM_THREADS=ALL_CPUS']
+    cube_ds = iolib.gtif_drv.Create(out_fn, r_ds.RasterXSize, r_ds.RasterYSize, len(ds_list), gdal.GDT_Float32, options=opt)
+    cube_ds.SetGeoTransform(r_ds.GetGeoTransform())
+    cube_ds.SetProjection(r_ds.GetProjection())
+    for n, t in enumerate(t_decyear):
+        b = cube_ds.GetRasterBand(n+1)
+        b.SetNoDataValue(ndv)
+        b.SetMetadataItem('DECYEAR', '%0.6f' % t)
+    for win in block_windows(r_ds):
+        for n, ds in enumerate(ds_list):
+            cube_ds.GetRasterBand(n+1).WriteArray(ds_getma_win(ds, win).filled(ndv), win[0], win[1])
+    cube_ds.FlushCache()
+    return cube_ds
+
+#Vectorized per-pixel weighted least-squares linear fit of z (time x y x x, masked) against t (decimal years)
+#w holds optional per-epoch weights (e.g., 1/sigma^2), and missing epochs get zero weight, so each pixel uses only its own observations
+#Returns slope (dh/dt), intercept at t_ref, weighted residual RMS and observation count, NaN where fewer than min_count observations
+def wls_trend(z, t, w=None, t_ref=None, min_count=2):
+    t = np.asarray(t, dtype=np.float64)
+    if t_ref is None:
+        t_ref = t.mean()
+    #Center times for numerical stability
+    tc = t - t_ref
+    w = np.ones_like(t) if w is None else np.asarray(w, dtype=np.float64)
+    valid = ~np.ma.getmaskarray(z)
+    zd = np.where(valid, np.ma.getdata(z), 0)
+    #Weighted sums over the time axis, accumulated in float64 without building (time, y, x) float64 temporaries
+    tsum = lambda wt, a: np.einsum('n,nij->ij', wt, a, dtype=np.float64)
+    S = tsum(w, valid)
+    St = tsum(w*tc, valid)
+    Sz = tsum(w, zd)
+    Stt = tsum(w*tc**2, valid)
+    Stz = tsum(w*tc, zd)
+    count = valid.sum(axis=0)
+    den = S * Stt - St**2
+    ok = (count >= min_count) & (den > 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = np.where(ok, (S * Stz - St * Sz) / den, np.nan)
+        intercept = np.where(ok, (Sz - slope * St) / S, np.nan)
+        #Residuals one epoch at a time, so only 2D temporaries are needed
+        ss = np.zeros_like(S)
+        for n in range(len(t)):
+            ss += w[n] * valid[n] * (zd[n] - (intercept + slope * tc[n]))**2
+        rms = np.where(ok, np.sqrt(ss / S), np.nan)
+    return slope, intercept, rms, count
+
+#Per-process state for _trend_tile
+_trend_ctx = {}
+
+def _init_trend_worker(cube_fn, labels_fn, nlabels, t_decyear, w, t_ref):
+    _trend_ctx['cube_ds'] = gdal.Open(cube_fn)
+    _trend_ctx['labels_ds'] = gdal.Open(labels_fn) if labels_fn is not None else None
+    _trend_ctx['nlabels'] = nlabels
+    _trend_ctx['t'] = t_decyear
+    _trend_ctx['w'] = w
+    _trend_ctx['t_ref'] = t_ref
+
+def _trend_tile(win):
+    cube_ds = _trend_ctx['cube_ds']
+    #The cube is pixel-interleaved, so read all epochs in one call rather than band by band
+    nb = cube_ds.RasterCount
+    z = np.ma.masked_invalid(cube_ds.ReadAsArray(*win).reshape((nb, win[3], win[2])))
+    for n in range(nb):
+        ndv = cube_ds.GetRasterBand(n+1).GetNoDataValue()
+        if ndv is not None:
+            z[n] = np.ma.masked_equal(z[n], ndv)
+    slope, intercept, rms, count = wls_trend(z, _trend_ctx['t'], _trend_ctx['w'], _trend_ctx['t_ref'])
+    stats = None
+    if _trend_ctx['labels_ds'] is not None:
+        labels = _trend_ctx['labels_ds'].GetRasterBand(1).ReadAsArray(*win)
+        stats = StreamStats(_trend_ctx['nlabels']).update(np.ma.masked_invalid(slope), labels)
+    return win, slope, intercept, rms, count, stats
+
+#Per-pixel dh/dt trend for every pixel of a DEM cube, in tiles across nproc worker processes
+#Writes a 4-band GeoTIFF (dhdt, intercept at t_ref, residual RMS, count) and returns its filename and
+#a labeled StreamStats of the trend if labels_ds is given
+def stream_trend(cube_ds, out_fn, t_decyear, w=None, labels_ds=None, nlabels=2, nproc=1, tile=512, ndv=-9999):
+    t_ref = np.mean(t_decyear)
+    out_ds = create_like(cube_ds, out_fn, 4, ndv=ndv)
+    for n, desc in enumerate(['dhdt', 'intercept_%0.2f' % t_ref, 'rms', 'count']):
+        out_ds.GetRasterBand(n+1).SetDescription(desc)
+    initargs = (cube_ds.GetDescription(), labels_ds.GetDescription() if labels_ds is not None else None, nlabels, t_decyear, w, t_ref)
+    win_list = list(block_windows(cube_ds, bs=(tile, tile)))
+    if nproc > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(nproc, initializer=_init_trend_worker, initargs=initargs)
+        results = pool.imap_unordered(_trend_tile, win_list)
+    else:
+        pool = None
+        _init_trend_worker(*initargs)
+        results = (_trend_tile(win) for win in win_list)
+    trend_stats = StreamStats(nlabels) if labels_ds is not None else None
+    for win, slope, intercept, rms, count, stats in results:
+        for n, a in enumerate((slope, intercept, rms)):
+            out_ds.GetRasterBand(n+1).WriteArray(np.where(np.isnan(a), ndv, a), win[0], win[1])
+        out_ds.GetRasterBand(4).WriteArray(count, win[0], win[1])
+        if stats is not None:
+            trend_stats.merge(stats)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    out_ds = None
+    return out_fn, trend_stats
+
+#Block-streaming version of the in-memory workflow below, for inputs that do not fit in RAM
+def stream_main(dem_fn_list, t_list, shp_fn, pair_list, dt_list, titles, args, t_srs, extent='intersection', res='min', \
+        dem_clim=(1000, 4400), dhdt_clim=(-3, 3)):
+    outdir = args.outdir
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    if args.lazy:
+        #Warped VRTs on disk, only the tiles that are read get resampled
+        ds_list = WarpedStack(dem_fn_list, extent=extent, res=res, t_srs=t_srs, outdir=outdir).ds_list
+    elif args.cachedir is not None:
+        ds_list = cached_warp_multi_fn(dem_fn_list, args.cachedir, extent=extent, res=res, t_srs=t_srs, max_bytes=args.cache_gb*2**30)
+    else:
+        #Warp to tiled, compressed GeoTIFFs on disk instead of in-memory GDAL datasets
+        ds_list = warplib.diskwarp_multi_fn(dem_fn_list, extent=extent, res=res, t_srs=t_srs, outdir=outdir)
+    labels_ds, names = shp2labels_ds(shp_fn, ds_list[0], os.path.join(outdir, 'glacier_labels.tif'))
+    out_fn, stats_list, hist_list = stream_dh(ds_list, pair_list, dt_list, labels_ds, len(names)+1, outdir, nproc=args.nproc, \
+            skip_empty=args.glacier_only, xlim=dem_clim, ylim=dhdt_clim)
+    for fn in sorted(out_fn.values()):
+        print('Wrote %s' % fn)
+    print('')
+    gt = ds_list[0].GetGeoTransform()
+    px_area = gt[1] * -gt[5]
+    zonal_fn = os.path.join(outdir, 'glacier_dhdt.csv')
+    write_zonal_csv(zonal_fn, names, titles, stats_list, px_area, dt_list)
+    print('Wrote %s\n' % zonal_fn)
+    #Totals over all glaciers
+    total_list = [stats.combined() for stats in stats_list]
+    dhdt_mean = np.array([stats.mean[0] for stats in total_list])
+    area_total = px_area * np.array([stats.count[0] for stats in total_list]) / 1E6
+    print_volmass(titles, dhdt_mean, area_total, dt_list)
+    plot_dem_vs_dhdt(hist_list, titles, fn=os.path.join(outdir, 'dem_vs_dhdt_log.png'))
+    #Quicklook of clipped rates over shaded relief, read from overviews of the products
+    hs_bands = [hs_index(pair_list).index(i) + 1 for i, j in pair_list]
+    job = {'fn_list':[(out_fn['dhdt_shpclip'], n+1) for n in range(len(pair_list))], \
+            'overlay':[(out_fn['hs'], b) for b in hs_bands], 'clim':(-2, 2), 'titles':titles, 'cmap':'RdBu', \
+            'label':'Elevation Change Rate (m/yr)', 'fn':os.path.join(outdir, 'dem_dhdt_shpclip_hs.png')}
+    render_batch([job])
+    if args.trend:
+        #Per-pixel linear trend through all epochs, instead of pairwise differences
+        t_decyear = np.array([timelib.dt2decyear(t) for t in t_list])
+        for ds in ds_list:
+            ds.FlushCache()
+        cube_ds = build_dem_cube(ds_list, t_decyear, os.path.join(outdir, 'dem_cube.tif'))
+        trend_fn, trend_stats = stream_trend(cube_ds, os.path.join(outdir, 'dem_trend.tif'), t_decyear, \
+                labels_ds=labels_ds, nlabels=len(names)+1, nproc=args.nproc)
+        print('Wrote %s' % trend_fn)
+        total = trend_stats.combined()
+        print('%0.2f m/yr mean glacier elevation change rate (%i-epoch trend)\n' % (total.mean[0], len(dem_fn_list)))
+
+def getparser():
+    parser = argparse.ArgumentParser(description='Mount Rainier DEM differencing and glacier volume/mass change')
+    parser.add_argument('--stream', action='store_true', help='Warp to disk and process block by block (for inputs that do not fit in memory)')
+    parser.add_argument('--outdir', default='rainier_out', help='Output directory for --stream products')
+    parser.add_argument('--cachedir', default=None, help='Reuse warped DEMs from this on-disk cache')
+    parser.add_argument('--cache_gb', type=float, default=20, help='Maximum warp cache size (GB), least recently used entries are evicted')
+    parser.add_argument('--lazy', action='store_true', help='Wrap inputs as warped VRTs and only resample windows that are read (without --stream, only saves work with --bbox)')
+    parser.add_argument('--bbox', type=float, nargs=4, default=None, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'), help='Limit the common grid to this extent (output projection)')
+    parser.add_argument('--glacier_only', action='store_true', help='With --stream, skip tiles that do not intersect the RGI polygons')
+    parser.add_argument('--batch', action='store_true', help='Headless rendering: Agg backend, one reused 3-panel figure, no plt.show()')
+    parser.add_argument('--render_jobs', default=None, help='JSON list of render_batch jobs to render headless (with --nproc workers), then exit')
+    parser.add_argument('--trend', action='store_true', help='With --stream, also fit a per-pixel linear dh/dt trend through all epochs')
+    parser.add_argument('--catalog', default=None, help='Select input DEMs from this SQLite catalog (DEMs intersecting the RGI polygons)')
+    parser.add_argument('--archive', nargs='+', default=None, help='With --catalog, first index new or changed DEMs under these directories')
+    parser.add_argument('--daterange', nargs=2, default=None, metavar=('T0', 'T1'), help='With --catalog, only select DEMs acquired between these dates (YYYYMMDD)')
+    parser.add_argument('--scratch', default=None, help='Keep dh and dh/dt layers as memory-mapped files in this directory, resuming from completed layers')
+    parser.add_argument('--nproc', type=int, default=1, help='Number of worker processes for --stream tiles (0 for all cores)')
+    return parser
+
+#Run the tutorial workflow
+#Kept out of module level so worker processes (--nproc) can import this file without rerunning it
+def main():
+    parser = getparser()
+    args = parser.parse_args()
+    for opt in ('glacier_only', 'trend'):
+        if getattr(args, opt) and not args.stream:
+            parser.error('--%s requires --stream' % opt)
+
+    if args.nproc == 0:
+        import multiprocessing
+        args.nproc = multiprocessing.cpu_count()
+
+    #Rendering saved jobs doesn't need the input DEMs or the catalog
+    if args.render_jobs is not None:
+        import json
+        with open(args.render_jobs) as f:
+            render_batch(json.load(f), args.nproc)
+        return
+
+    #Input DEM filenames
+    dem_1970_fn = '19700901_ned1_2003_adj_warp.tif'
+    dem_2008_fn = '20080901_rainierlidar_10m-adj.tif'
+    dem_2015_fn = '20150818_rainier_summer-tile-0.tif'
+    dem_fn_list = [dem_1970_fn, dem_2008_fn, dem_2015_fn]
+    #RGI glacier polygons
+    shp_fn = 'rgi60_glacierpoly_rainier.shp'
+
+    if args.catalog is not None:
+        #Instead, pick every cataloged DEM over the glaciers (in time order), with timestamps parsed when they were indexed
+        catalog = DemCatalog(args.catalog)
+        if args.archive is not None:
+            print('Catalog: %i DEMs indexed, %i removed' % catalog.update(args.archive))
+        t0, t1 = [timelib.fn_getdatetime(t) for t in args.daterange] if args.daterange is not None else (None, None)
+        dem_fn_list = catalog.query(bbox=shp_extent(shp_fn), t0=t0, t1=t1)
+        if len(dem_fn_list) < 2:
+            sys.exit('Need at least 2 DEMs, found %i in %s' % (len(dem_fn_list), args.catalog))
+        #Output projection of the latest DEM, fixed here so the grid below and the warps agree even if pruning drops that DEM
+        t_srs = osr.SpatialReference(catalog.con.execute('SELECT srs FROM raster WHERE fn = ?', (dem_fn_list[-1],)).fetchone()[0])
+        #Get the common grid from cataloged headers, so the warp doesn't have to open every candidate just to work out the intersection
+        #The catalog query already matched the glacier bbox in lon/lat, so pruning here only drops DEMs that stop overlapping
+        #once reprojected, which is rare
+        fp_index = FootprintIndex.from_catalog(catalog, dem_fn_list, t_srs)
+        dem_fn_list, warp_extent, union_extent, warp_res = fp_index.select(shp_extent(shp_fn, t_srs))
+        if len(dem_fn_list) < 2 or warp_extent is None:
+            sys.exit('Need at least 2 overlapping DEMs over the glaciers, found %i' % len(dem_fn_list))
+        t_list = np.array(catalog.datetimes(dem_fn_list))
+    else:
+        #Output projection of the latest DEM
+        t_srs = geolib.get_ds_srs(gdal.Open(dem_fn_list[-1]))
+        #Common grid from the headers, pruned to DEMs that overlap --bbox, so warplib doesn't reopen every input for it
+        fp_index = FootprintIndex.from_headers(dem_fn_list, t_srs)
+        dem_fn_list, warp_extent, union_extent, warp_res = fp_index.select(args.bbox)
+        if len(dem_fn_list) < 2 or warp_extent is None:
+            sys.exit('Need at least 2 overlapping DEMs, found %i' % len(dem_fn_list))
+        #Extract timestamps from filenames
+        t_list = np.array([timelib.fn_getdatetime(fn) for fn in dem_fn_list])
+    #Common warp grid: --bbox, else the footprint intersection of the inputs
+    if args.bbox is not None:
+        warp_extent = args.bbox
+    #Index pairs (earlier, later) for each period: consecutive DEMs, then first to last
+    pair_list = [(n, n+1) for n in range(len(dem_fn_list)-1)]
+    if len(dem_fn_list) > 2:
+        pair_list.append((0, len(dem_fn_list)-1))
+    #Compute time differences, convert decimal years
+    dt_list = [timelib.timedelta2decyear(t_list[j] - t_list[i]) for i, j in pair_list]
+    titles = ['%i to %i (%0.1f yr)' % (t_list[i].year, t_list[j].year, dt) for (i, j), dt in zip(pair_list, dt_list)]
+    #Elevation and elevation change rate limits for 2D histograms
+    dem_clim = (1000,4400)
+    dhdt_clim = (-3, 3)
+
+    #In batch mode, render without a display and reuse one figure per panel count
+    #(the number of DEMs and pairs varies with --catalog)
+    if args.batch:
+        plt.switch_backend('Agg')
+
+    if args.stream:
+        stream_main(dem_fn_list, t_list, shp_fn, pair_list, dt_list, titles, args, t_srs, warp_extent, warp_res, dem_clim, dhdt_clim)
+        return
+
+    #This will return warped, in-memory GDAL dataset objects, on the grid of the latest DEM
+    #Can also resample all inputs to a lower resolution (res=256)
+    #With --cachedir, warped outputs from a previous run with the same inputs and parameters are reused from disk
+    #With --lazy, ds_list holds warped VRTs, and pixels are only resampled when read (e.g., for a --bbox subset)
+    if args.lazy:
+        #ds_getma below reads every full VRT, so without --bbox everything is still resampled, just later
+        if args.bbox is None:
+            print('Warning: --lazy without --bbox still warps the full grid into memory')
+        ds_list = WarpedStack(dem_fn_list, extent=warp_extent, res=warp_res, t_srs=t_srs).ds_list
+    elif args.cachedir is not None:
+        ds_list = cached_warp_multi_fn(dem_fn_list, args.cachedir, extent=warp_extent, res=warp_res, t_srs=t_srs, max_bytes=args.cache_gb*2**30)
+    else:
+        ds_list = warplib.memwarp_multi_fn(dem_fn_list, extent=warp_extent, res=warp_res, t_srs=t_srs)
+
+    #Load datasets to NumPy masked arrays, then keep the data with packed validity masks (1 bit per pixel instead of 1 byte)
+    #dem_list still yields masked arrays when indexed or iterated
+    #Each DEM is packed as soon as it is read, so only one full byte mask exists at a time
+    dem_data, dem_valid = [], []
+    for ds in ds_list:
+        dem = iolib.ds_getma(ds)
+        dem_data.append(np.ma.getdata(dem))
+        dem_valid.append(BitMask.from_ma(dem))
+        dem = None
+    dem_list = PackedMaskedList(dem_data, dem_valid)
+
+    clim = malib.calcperc(dem_list[0], (2,98))
+    plot3panel(dem_list, clim, [str(t.year) for t in t_list], 'inferno', 'Elevation (m WGS84)', fn='dem.png', batch=args.batch)
+
+    #ddem_1970_2015 = dem_1970 - dem_2015
+    #ddem_2008_2015 = dem_2008 - dem_2015
+    #ddem_1970_2008 = dem_1970 - dem_2008
+
+    #Calculate elevation difference for each time period 
+    #Differences are valid where both DEMs are valid, so combine the packed masks rather than carrying a new mask for each array
+    dh_valid = [dem_valid[i] & dem_valid[j] for i, j in pair_list]
+    if args.scratch is None:
+        dh_list = PackedMaskedList([dem_list.data_list[j] - dem_list.data_list[i] for i, j in pair_list], dh_valid)
+    else:
+        #Or write the differences to memory-mapped files, reusing any that a previous (possibly crashed) run already completed
+        #The key ties stored layers to the inputs and the warped grid
+        scratch_key = repr([(fn, os.path.getmtime(fn)) for fn in dem_fn_list] + [ds_list[0].GetGeoTransform(), dem_valid[0].shape])
+        scratch = ScratchStore(args.scratch, scratch_key)
+        dtype = dem_list.data_list[0].dtype
+        dh_list = PackedMaskedList(*zip(*[scratch.get('dh_%i_%i' % (i, j), \
+                lambda out: np.subtract(dem_list.data_list[j], dem_list.data_list[i], out=out), dh_valid[n], dtype) \
+                for n, (i, j) in enumerate(pair_list)]))
+    plot3panel(dh_list, (-30, 30), titles, 'RdBu', 'Elevation Change (m)', fn='dem_dh.png', batch=args.batch)
+
+    #Calculate annual rate of change
+    if args.scratch is None:
+        dhdt_list = PackedMaskedList([dh / dt for dh, dt in zip(dh_list.data_list, dt_list)], dh_valid)
+    else:
+        dhdt_list = PackedMaskedList(*zip(*[scratch.get('dhdt_%i_%i' % (i, j), \
+                lambda out: np.divide(dh_list.data_list[n], dt_list[n], out=out), dh_list.valid_list[n], dtype) \
+                for n, (i, j) in enumerate(pair_list)]))
+    plot3panel(dhdt_list, (-2, 2), titles, 'RdBu', 'Elevation Change Rate (m/yr)', fn='dem_dhdt.png', batch=args.batch)
+
+    #Hmmm, strange positive signals over trees for some of these.  Are they growing 3 m/yr?  That would be exciting, but probably not.  Looks like our 1970 and 2008 DEMs were "bare-ground" digital terrain models (DTMs), while the 2015 DEM was a digital surface model (DSM) that included vegetation.
+    #Let's clip our map to the glaciers using polygons from the Randolph Glacier Inventory (RGI)
+    #Rasterize the polygons once to an integer label raster (0 outside, n for the nth glacier) to match our warped raster datasets
+    labels_ds, glacier_names = shp2labels_ds(shp_fn, ds_list[0])
+    glacier_labels = labels_ds.GetRasterBand(1).ReadAsArray()
+    #Create binary mask from the labels
+    glacier_valid = BitMask.from_bool(glacier_labels > 0)
+    #Now apply the mask to each array, sharing the dh/dt data
+    dhdt_list_shpclip = PackedMaskedList(dhdt_list.data_list, [v & glacier_valid for v in dh_valid])
+    plot3panel(dhdt_list_shpclip, (-2, 2), titles, 'RdBu', 'Elevation Change Rate (m/yr)', fn='dem_dhdt_shpclip.png', batch=args.batch)
+
+    #That looks pretty good, but context would be nice.
+    #Let's generate some shaded relief basemaps, using the same algorithm as gdaldem hillshade on tiles across all cores
+    #Use the DEM from the start of each period, computing each hillshade only once (1970 is used twice)
+    hs_cache = {}
+    for i, j in pair_list:
+        if i not in hs_cache:
+            hs_cache[i] = iolib.ds_getma(dem_derivative_ds(ds_list[i], 'hillshade'))
+    hs_list = [hs_cache[i] for i, j in pair_list]
+
+    #Plot our clipped rates over shaded relief maps
+    plot3panel(dhdt_list_shpclip, (-2, 2), titles, 'RdBu', 'Elevation Change Rate (m/yr)', overlay=hs_list, fn='dem_dhdt_shpclip_hs.png', batch=args.batch)
+
+    #OK, so we have elevation change, what about volume and mass change during different periods? 
+    #Extract x and y pixel resolution (m) from geotransform
+    gt = ds_list[0].GetGeoTransform()
+    px_res = (gt[1], -gt[5])
+    #Calculate pixel area in m^2
+    px_area = px_res[0]*px_res[0]
+    #Accumulate count, mean, variance, min and max over valid glacier pixels for each period in a single pass
+    dhdt_stats = reduce_stack(dhdt_list_shpclip)
+    #Now, lets multiple pixel area by the observed elevation change for all valid pixels over glaciers
+    dhdt_mean = np.array([stats.mean[0] for stats in dhdt_stats])
+    #Compute area in km^2
+    area_total = px_area * np.array([stats.count[0] for stats in dhdt_stats]) / 1E6
+    #Compute volume and mass change, print some numbers
+    print_volmass(titles, dhdt_mean, area_total, dt_list)
+
+    #Same numbers for each individual glacier, using the label raster in the same kind of single pass
+    dhdt_zonal_stats = reduce_stack(dhdt_list_shpclip, glacier_labels, len(glacier_names)+1)
+    write_zonal_csv('glacier_dhdt.csv', glacier_names, titles, dhdt_zonal_stats, px_area, dt_list)
+
+    #Now, let's make some quick plots of elevation change vs. elevation for the two time periods
+    #Counts are accumulated in row chunks, so the filtered x/y pixel arrays are never materialized
+    dem_hist_list = [Hist2D(dem_clim, dhdt_clim).update_chunks(dem_list[i], dhdt_list_shpclip[n]) for n, (i, j) in enumerate(pair_list[:2])]
+    plot_dem_vs_dhdt(dem_hist_list, ['%i to %i' % (t_list[i].year, t_list[j].year) for i, j in pair_list[:2]], fn='dem_vs_dhdt_log.png')
+
+    #And the numbers behind these plots: dh/dt statistics in 100 m elevation bands, for each glacier and period
+    z_edges = np.arange(dem_clim[0], dem_clim[1]+100, 100)
+    write_hypso_csv('glacier_hypso_dhdt.csv', titles, dem_list, dhdt_list_shpclip, pair_list, glacier_labels, glacier_names, z_edges)
+    if not args.batch:
+        plt.show()
+
+if __name__ == '__main__':
+    main()